@@ -1,12 +1,25 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import gspread
+from gspread.utils import a1_range_to_grid_range, fill_gaps, numericise_all, rowcol_to_a1
 from google.oauth2.service_account import Credentials
 from datetime import datetime, date, timedelta
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
+import sqlite3
+import threading
+import time
+import zipfile
 import base64
 import hashlib
+import io
 import os
+import random
 import requests
+import shutil
+from string import Template
+import subprocess
 from urllib.parse import unquote, quote
 import anthropic
 import smtplib
@@ -32,25 +45,373 @@ def get_gc():
 
 @st.cache_resource
 def get_sheet():
-    return get_gc().open_by_key(st.secrets["app"]["sheet_id"])
+    return _with_backoff(lambda: get_gc().open_by_key(st.secrets["app"]["sheet_id"]))
+
+def _error_status(e):
+    """HTTP-ish status of a storage error: 429 for quota, 503 for transport failures."""
+    if isinstance(e, StorageQuotaError):
+        return 429
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return 503
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _with_backoff(call, retry_5xx=True, retries=5, on_retry=None):
+    """Run call(), retrying 429s — and 5xx/transport errors when retry_5xx — with
+    jittered exponential backoff (about 1, 2, 4 … 32 s)."""
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except Exception as e:
+            status = _error_status(e)
+            if attempt == retries or not (status == 429 or (retry_5xx and status and status >= 500)):
+                raise
+            if on_retry:
+                on_retry(status)
+            time.sleep(min(32.0, 2 ** attempt) * (0.5 + random.random()))
+
+# ── Storage backends ───────────────────────────────────────────────────────────
+
+class StorageQuotaError(Exception):
+    """A backend refused a request for exceeding its per-minute quota."""
+
+class SheetsBackend:
+    """The workbook on the live Google Sheet, via gspread.
+    Ranges are A1 notation; worksheet handles are cached per title."""
+
+    def __init__(self, sh):
+        self.sh  = sh
+        self._ws = {}
+
+    def _sheet(self, title):
+        if title not in self._ws:
+            self._ws[title] = self.sh.worksheet(title)
+        return self._ws[title]
+
+    def titles(self):
+        self._ws = {ws.title: ws for ws in self.sh.worksheets()}
+        return list(self._ws)
+
+    def add_sheet(self, title, rows, cols):
+        self._ws[title] = self.sh.add_worksheet(title, rows, cols)
+
+    def size(self, title):
+        ws = self._sheet(title)
+        return ws.row_count, ws.col_count
+
+    def resize(self, title, cols):
+        self._sheet(title).resize(cols=cols)
+
+    def batch_get(self, ranges):
+        """Values for several ranges ("'Sheet'" or "'Sheet'!A1:B2") in one request."""
+        resp = self.sh.values_batch_get(ranges)
+        return [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+
+    def update(self, title, a1, values):
+        self._sheet(title).update(range_name=a1, values=values)
+
+    def batch_update(self, title, updates):
+        """[(a1, values), ...] in one request — all land or none do."""
+        self._sheet(title).batch_update([{"range": a1, "values": v} for a1, v in updates])
+
+    def batch_write(self, updates):
+        """[(title, a1, values), ...] across worksheets, in one request."""
+        self.sh.values_batch_update(body={
+            "valueInputOption": "RAW",
+            "data": [{"range": f"'{t}'!{a1}", "values": v} for t, a1, v in updates],
+        })
+
+    def append_rows(self, title, rows):
+        """Append rows; returns the sheet row number the first one landed on (or None)."""
+        resp = self._sheet(title).append_rows(rows)
+        try:
+            return a1_range_to_grid_range(resp["updates"]["updatedRange"].split("!")[-1])["startRowIndex"] + 1
+        except Exception:
+            return None
+
+    def delete_row(self, title, n):
+        self._sheet(title).delete_rows(n)
+
+    def modified_time(self):
+        """When anything in the workbook last changed, hand edits included (Drive API)."""
+        return self.sh.get_lastUpdateTime()
+
+def _cell_text(v):
+    """How Sheets displays a stored value (FORMATTED_VALUE reads)."""
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return "TRUE" if v else "FALSE"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+class LocalBackend:
+    """In-process stand-in for the workbook, for offline runs, benchmarks and load tests.
+
+    Worksheets live in memory, and in a JSON file when path is set. Every call
+    sleeps latency_ms, and more than quota_per_minute calls in a rolling minute
+    raise StorageQuotaError, the way the Sheets API answers 429."""
+
+    def __init__(self, path=None, latency_ms=0, quota_per_minute=0):
+        self.path    = path
+        self.latency = float(latency_ms) / 1000
+        self.quota   = int(quota_per_minute)
+        self.sheets  = {}
+        self._calls  = collections.deque()
+        self._lock   = threading.RLock()
+        self.modified = datetime.now().isoformat()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.sheets = json.load(f)
+            self.modified = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+
+    def _call(self):
+        with self._lock:
+            now = time.monotonic()
+            while self._calls and now - self._calls[0] > 60:
+                self._calls.popleft()
+            if self.quota and len(self._calls) >= self.quota:
+                raise StorageQuotaError(f"Local backend quota of {self.quota} requests/minute exceeded")
+            self._calls.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _save(self):
+        self.modified = datetime.now().isoformat()
+        if self.path:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.sheets, f)
+            os.replace(tmp, self.path)
+
+    def _used(self, title):
+        """The sheet's values without trailing blank rows."""
+        grid = self.sheets[title]["values"]
+        n = len(grid)
+        while n and not any(_cell_text(v) for v in grid[n - 1]):
+            n -= 1
+        return grid[:n]
+
+    def titles(self):
+        self._call()
+        return list(self.sheets)
+
+    def modified_time(self):
+        self._call()
+        return self.modified
+
+    def add_sheet(self, title, rows, cols):
+        self._call()
+        with self._lock:
+            self.sheets[title] = {"rows": rows, "cols": cols, "values": []}
+            self._save()
+
+    def size(self, title):
+        sheet = self.sheets[title]
+        return max(sheet["rows"], len(sheet["values"])), sheet["cols"]
+
+    def resize(self, title, cols):
+        self._call()
+        with self._lock:
+            self.sheets[title]["cols"] = cols
+            self._save()
+
+    def batch_get(self, ranges):
+        self._call()
+        out = []
+        with self._lock:
+            for rng in ranges:
+                title, _, a1 = rng.partition("!")
+                grid = self._used(title.strip("'").replace("''", "'"))
+                if a1:
+                    g    = a1_range_to_grid_range(a1)
+                    grid = [row[g.get("startColumnIndex", 0):g.get("endColumnIndex")]
+                            for row in grid[g.get("startRowIndex", 0):g.get("endRowIndex")]]
+                values = [[_cell_text(v) for v in row] for row in grid]
+                for row in values:
+                    while row and row[-1] == "":
+                        row.pop()
+                while values and not values[-1]:
+                    values.pop()
+                out.append(values)
+        return out
+
+    def _write(self, title, a1, values):
+        g    = a1_range_to_grid_range(a1)
+        r0   = g.get("startRowIndex", 0)
+        c0   = g.get("startColumnIndex", 0)
+        grid = self.sheets[title]["values"]
+        for dr, vals in enumerate(values):
+            while len(grid) <= r0 + dr:
+                grid.append([])
+            line = grid[r0 + dr]
+            for dc, v in enumerate(vals):
+                while len(line) <= c0 + dc:
+                    line.append("")
+                line[c0 + dc] = v
+
+    def update(self, title, a1, values):
+        self.batch_update(title, [(a1, values)])
+
+    def batch_update(self, title, updates):
+        self._call()
+        with self._lock:
+            for a1, v in updates:
+                self._write(title, a1, v)
+            self._save()
+
+    def batch_write(self, updates):
+        self._call()
+        with self._lock:
+            for t, a1, v in updates:
+                self._write(t, a1, v)
+            self._save()
+
+    def append_rows(self, title, rows):
+        self._call()
+        with self._lock:
+            n = len(self._used(title)) + 1
+            self.sheets[title]["values"][n - 1:] = [list(r) for r in rows]
+            self._save()
+        return n
+
+    def delete_row(self, title, n):
+        self._call()
+        with self._lock:
+            grid = self.sheets[title]["values"]
+            if n - 1 < len(grid):
+                del grid[n - 1]
+            self._save()
+
+class _TokenBucket:
+    """per_minute acquisitions per minute on average, in bursts of up to ~10 s worth."""
+
+    def __init__(self, per_minute):
+        self.rate     = per_minute / 60.0
+        self.capacity = max(1.0, per_minute / 6.0)
+        self.tokens   = self.capacity
+        self.updated  = time.monotonic()
+        self.lock     = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is free; returns the seconds spent waiting."""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now          = time.monotonic()
+                self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class MeteredBackend:
+    """Quota-aware wrapper around a storage backend.
+
+    Every request first takes a token from the read or write bucket, so the
+    process stays under the Sheets per-minute quota instead of hitting it.
+    429s, and 5xx/transport errors on idempotent calls, are retried with
+    jittered exponential backoff; appends and deletes only retry 429s, since a
+    5xx may still have applied them. stats counts requests per worksheet."""
+
+    IDEMPOTENT = {"titles", "batch_get", "update", "batch_update", "batch_write", "resize", "modified_time"}
+
+    def __init__(self, inner, reads_per_minute=60, writes_per_minute=60):
+        self.inner   = inner
+        self.buckets = {"read": _TokenBucket(reads_per_minute), "write": _TokenBucket(writes_per_minute)}
+        self.stats   = collections.Counter()
+        self._lock   = threading.Lock()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _call(self, kind, op, titles, *args):
+        def attempt():
+            self._count(("wait_s", kind), self.buckets[kind].acquire())
+            for t in titles:
+                self._count((kind, t))
+            return getattr(self.inner, op)(*args)
+        return _with_backoff(attempt, retry_5xx=op in self.IDEMPOTENT,
+                             on_retry=lambda status: self._count(("retry", status)))
+
+    def titles(self):
+        return self._call("read", "titles", ["(workbook)"])
+
+    def modified_time(self):
+        return self._call("read", "modified_time", ["(workbook)"])
+
+    def add_sheet(self, title, rows, cols):
+        return self._call("write", "add_sheet", [title], title, rows, cols)
+
+    def size(self, title):
+        return self.inner.size(title)   # cached sheet metadata, no request
+
+    def resize(self, title, cols):
+        return self._call("write", "resize", [title], title, cols)
+
+    def batch_get(self, ranges):
+        titles = [r.partition("!")[0].strip("'").replace("''", "'") for r in ranges]
+        return self._call("read", "batch_get", titles, ranges)
+
+    def update(self, title, a1, values):
+        return self._call("write", "update", [title], title, a1, values)
+
+    def batch_update(self, title, updates):
+        return self._call("write", "batch_update", [title], title, updates)
+
+    def batch_write(self, updates):
+        return self._call("write", "batch_write", list(dict.fromkeys(u[0] for u in updates)), updates)
+
+    def append_rows(self, title, rows):
+        return self._call("write", "append_rows", [title], title, rows)
+
+    def delete_row(self, title, n):
+        return self._call("write", "delete_row", [title], title, n)
+
+@st.cache_resource
+def _storage():
+    """Workbook backend from [storage] in secrets: backend = "sheets" (default) or
+    "local", with optional path, latency_ms and quota_per_minute for "local", and
+    reads_per_minute / writes_per_minute client-side limits (default 60, 0 = off)."""
+    cfg = dict(st.secrets.get("storage", {}))
+    if cfg.get("backend", "sheets") == "local":
+        inner = LocalBackend(cfg.get("path"), cfg.get("latency_ms", 0), cfg.get("quota_per_minute", 0))
+    else:
+        inner = SheetsBackend(get_sheet())
+    return MeteredBackend(inner, float(cfg.get("reads_per_minute", 60)), float(cfg.get("writes_per_minute", 60)))
+
+def storage_stats():
+    """Per-worksheet request counts for this process, for the Settings tab."""
+    stats = _storage().stats
+    names = sorted({t for (kind, t) in stats if kind in ("read", "write")})
+    return [{"worksheet": t, "reads": stats[("read", t)], "writes": stats[("write", t)]} for t in names]
 
 DOC_HEADERS = [
     "doc_id", "doc_type", "status", "project_name", "client_name",
     "billing_address", "delivery_address", "doc_date", "validity_date",
     "transport", "transport_amount", "items_json", "terms_json", "created_at",
     "approval_token", "approved_by", "approved_at", "signature_b64", "notes", "doc_code",
-    "vehicle_no", "transporter_name", "distance_km", "transport_mode",
+    "vehicle_no", "transporter_name", "distance_km", "transport_mode", "pdf_sha256",
 ]
 DISPATCH_HEADERS  = [
     "dispatch_id", "source_doc_id", "status", "client_name", "project_name",
     "billing_address", "delivery_address", "vehicle_no", "transporter_name",
     "transport_mode", "purpose", "items_json", "created_at", "finalized_at",
+    "pdf_sha256",
 ]
 TEMPLATE_HEADERS  = ["name", "terms_json"]
 MANAGER_HEADERS   = ["name", "whatsapp", "pin", "signature_b64"]
 CLIENT_HEADERS    = ["name", "billing_address", "delivery_address", "gst_number", "payment_terms", "notes", "email", "contact_name"]
 ITEM_HEADERS      = ["item_code", "description", "unit", "base_rate", "category", "sale_types", "supply_rate", "installation_rate"]
 SETTINGS_HEADERS  = ["key", "value"]
+WO_HEADERS        = ["wo_id", "client_name", "project_name", "scope",
+                     "items_json", "milestones_json", "terms_json", "created_at", "status"]
 
 DEFAULT_BANK = {
     "bank_name":    "Bank Name",
@@ -73,88 +434,96 @@ STATE_NAMES = {
     "34":"Puducherry","36":"Telangana","37":"Andhra Pradesh (New)",
 }
 
-@st.cache_resource
-def ensure_sheets():
-    sh = get_sheet()
-    existing = [ws.title for ws in sh.worksheets()]
+# Every worksheet ensure_sheets() maintains: title → (header row, rows for a new sheet)
+SHEET_LAYOUT = {
+    "Documents":       (DOC_HEADERS,      1000),
+    "Terms_Templates": (TEMPLATE_HEADERS, 100),
+    "Managers":        (MANAGER_HEADERS,  20),
+    "Clients":         (CLIENT_HEADERS,   500),
+    "Items":           (ITEM_HEADERS,     500),
+    "Work_Orders":     (WO_HEADERS,       500),
+    "Settings":        (SETTINGS_HEADERS, 50),
+    "Dispatches":      (DISPATCH_HEADERS, 500),
+}
 
-    if "Documents" not in existing:
-        ws = sh.add_worksheet("Documents", 1000, len(DOC_HEADERS))
-        ws.update("A1", [DOC_HEADERS])
-    else:
-        # Fix headers if they are outdated or have empty columns
-        ws = sh.worksheet("Documents")
-        ws.update("A1", [DOC_HEADERS])
+DEFAULT_TERMS = [
+    ["Standard", json.dumps([
+        "Prices are exclusive of GST.",
+        "Material will be delivered within 10-15 working days.",
+        "Payment within 10 days of delivery.",
+        "Actual billing will be done as per the number of pieces supplied.",
+        "Labour accommodation shall be provided by client.",
+    ])],
+    ["Quick Delivery", json.dumps([
+        "All materials in stock. Delivery within 5 days.",
+        "Immediate invoicing after dispatch.",
+        "Payment within 3 days of delivery.",
+    ])],
+]
 
+@st.cache_resource
+def ensure_sheets():
+    """Create missing worksheets and fix outdated header rows, then warm the data caches.
+
+    One listing call, one batched read of every header row, and one batched
+    write of only the headers that differ — a workbook that is already set up
+    costs two requests."""
+    db       = _storage()
+    existing = set(db.titles())
+    present  = [t for t in SHEET_LAYOUT if t in existing]
+    ranges   = [f"'{t}'!1:1" for t in present]
+    if VERSIONS_SHEET in existing:
+        ranges.append(f"'{VERSIONS_SHEET}'!A:B")
+    current = dict(zip(present + [VERSIONS_SHEET], db.batch_get(ranges))) if ranges else {}
+
+    writes = []
+    for title, (headers, rows) in SHEET_LAYOUT.items():
+        if title not in existing:
+            db.add_sheet(title, rows, len(headers))
+        elif db.size(title)[1] < len(headers):
+            # Resize if needed (Items was originally created with 5 cols)
+            db.resize(title, len(headers))
+        row = (current.get(title) or [[]])[0]
+        if row[:len(headers)] != headers:
+            writes.append((title, "A1", [headers]))
+
+    # One version stamp per data sheet, bumped by every write this app makes
+    if VERSIONS_SHEET not in existing:
+        db.add_sheet(VERSIONS_SHEET, 20, 2)
+    stamps = current.get(VERSIONS_SHEET) or [[]]
+    if stamps[0][:2] != ["sheet", "version"]:
+        writes.append((VERSIONS_SHEET, "A1", [["sheet", "version"]]))
+    if [r[:1] for r in stamps[1:len(SNAPSHOT_SHEETS) + 1]] != [[t] for t in SNAPSHOT_SHEETS]:
+        writes.append((VERSIONS_SHEET, "A2", [[t] for t in SNAPSHOT_SHEETS]))
+
+    if writes:
+        db.batch_write(writes)
     if "Terms_Templates" not in existing:
-        ws = sh.add_worksheet("Terms_Templates", 100, 2)
-        ws.update("A1", [TEMPLATE_HEADERS])
-        ws.append_row(["Standard", json.dumps([
-            "Prices are exclusive of GST.",
-            "Material will be delivered within 10-15 working days.",
-            "Payment within 10 days of delivery.",
-            "Actual billing will be done as per the number of pieces supplied.",
-            "Labour accommodation shall be provided by client.",
-        ])])
-        ws.append_row(["Quick Delivery", json.dumps([
-            "All materials in stock. Delivery within 5 days.",
-            "Immediate invoicing after dispatch.",
-            "Payment within 3 days of delivery.",
-        ])])
-    else:
-        sh.worksheet("Terms_Templates").update("A1", [TEMPLATE_HEADERS])
-
-    if "Managers" not in existing:
-        ws = sh.add_worksheet("Managers", 20, 4)
-        ws.update("A1", [MANAGER_HEADERS])
-    else:
-        sh.worksheet("Managers").update("A1", [MANAGER_HEADERS])
-
-    if "Clients" not in existing:
-        ws = sh.add_worksheet("Clients", 500, 6)
-        ws.update("A1", [CLIENT_HEADERS])
-    else:
-        sh.worksheet("Clients").update("A1", [CLIENT_HEADERS])
-
-    if "Items" not in existing:
-        ws = sh.add_worksheet("Items", 500, len(ITEM_HEADERS))
-        ws.update("A1", [ITEM_HEADERS])
-    else:
-        ws = sh.worksheet("Items")
-        # Resize if needed (Items was originally created with 5 cols)
-        if ws.col_count < len(ITEM_HEADERS):
-            ws.resize(cols=len(ITEM_HEADERS))
-        ws.update("A1", [ITEM_HEADERS])
-
-    if "Work_Orders" not in existing:
-        ws = sh.add_worksheet("Work_Orders", 500, len(WO_HEADERS))
-        ws.update("A1", [WO_HEADERS])
-    else:
-        ws = sh.worksheet("Work_Orders")
-        if ws.col_count < len(WO_HEADERS):
-            ws.resize(cols=len(WO_HEADERS))
-        ws.update("A1", [WO_HEADERS])
-
+        db.append_rows("Terms_Templates", DEFAULT_TERMS)
     if "Settings" not in existing:
-        ws = sh.add_worksheet("Settings", 50, 2)
-        ws.update("A1", [SETTINGS_HEADERS])
         # Seed default bank detail rows
-        for k, v in DEFAULT_BANK.items():
-            ws.append_row([k, v])
-    else:
-        sh.worksheet("Settings").update("A1", [SETTINGS_HEADERS])
-
-    if "Dispatches" not in existing:
-        ws = sh.add_worksheet("Dispatches", 500, len(DISPATCH_HEADERS))
-        ws.update("A1", [DISPATCH_HEADERS])
-    else:
-        ws = sh.worksheet("Dispatches")
-        if ws.col_count < len(DISPATCH_HEADERS):
-            ws.resize(cols=len(DISPATCH_HEADERS))
-        ws.update("A1", [DISPATCH_HEADERS])
+        db.append_rows("Settings", [[k, v] for k, v in DEFAULT_BANK.items()])
+
+    # Load the data caches side by side rather than one by one on the first page.
+    # A failure here is left for the page's own call to retry and report.
+    with _ctx_pool(3, "warm-up") as pool:
+        resume = (_outbox,) if st.secrets.get("smtp") else ()   # start sending mail left queued by the last run
+        for fut in [pool.submit(f) for f in (_replica, _fetch_snapshot, _fetch_settings, warm_assets, *resume)]:
+            fut.exception()
+    try:
+        repair_approvals()
+    except Exception:
+        pass   # Sheets unreachable — the next cold start tries again
 
 # ── Helpers ────────────────────────────────────────────────────────────────────
 
+def _ctx_pool(workers, name):
+    """A thread pool whose threads carry this script run's context, so work
+    submitted to it can use the st.cache_* helpers like the page itself."""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name,
+                              initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+
 def generate_doc_id(doc_type, code=""):
     records = _fetch_documents()
     prefix = {"Quotation": "QT", "Proforma Invoice": "PI", "Tax Invoice": "TI", "Challan": "DC"}.get(doc_type, "DOC")
@@ -164,6 +533,15 @@ def generate_doc_id(doc_type, code=""):
     count = sum(1 for r in records if str(r.get("doc_id", "")).startswith(base)) + 1
     return f"{base}{count:03d}"
 
+def _iso_time(value):
+    """value as a datetime when it is one or an ISO timestamp, else None."""
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+
 def make_token(doc_id):
     secret = st.secrets["app"]["approval_secret"]
     return hashlib.sha256(f"{doc_id}{secret}".encode()).hexdigest()[:16]
@@ -172,15 +550,14 @@ def format_inr(amount):
     try:
         amount = float(amount)
         integer = str(int(amount))
-        decimal = f"{amount:.2f}".split(".")[1]
+        decimal = f"{amount:.2f}"[-2:]
         if len(integer) > 3:
-            last3 = integer[-3:]
             rest = integer[:-3]
-            groups = []
-            while rest:
-                groups.insert(0, rest[-2:])
-                rest = rest[:-2]
-            return ",".join(groups) + "," + last3 + "." + decimal
+            head = len(rest) % 2
+            groups = [rest[i:i + 2] for i in range(head, len(rest), 2)]
+            if head:
+                groups.insert(0, rest[0])
+            return ",".join(groups) + "," + integer[-3:] + "." + decimal
         return integer + "." + decimal
     except Exception:
         return str(amount)
@@ -210,31 +587,98 @@ def amount_in_words(n):
         parts.append(three(n))
     return " ".join(parts) + " Only"
 
-def img_b64(path):
-    if os.path.exists(path):
-        with open(path, "rb") as f:
-            return base64.b64encode(f.read()).decode()
-    return None
-
-# ── AI Extraction ──────────────────────────────────────────────────────────────
-
-def extract_boq_from_file(uploaded_file):
-    """Send image or PDF to Claude and extract structured BOQ / work order data."""
-    client = anthropic.Anthropic(api_key=st.secrets["anthropic"]["api_key"])
-
-    file_bytes = uploaded_file.read()
-    file_b64   = base64.b64encode(file_bytes).decode()
-    mime       = uploaded_file.type  # e.g. image/jpeg, image/png, application/pdf
+# ── Assets ─────────────────────────────────────────────────────────────────────
+#
+# Images and fonts embedded in the PDF templates are prepared once per process
+# and kept encoded in memory; templates never fetch anything over the network.
+
+LOGO_PATH   = "MIRU GRC _INDIAS FASTEST GROWING BRAND_Black.png"
+LOGO_HEIGHT = 50   # CSS px the quotation template prints it at
+FONT_DIR    = "fonts"   # Poppins 4.004 (OFL, see fonts/OFL.txt), subset to FONT_UNICODES
+# Poppins weights the quotation template uses → bundled file stem (.woff2, .woff or .ttf)
+FONT_FACES  = {300: "Poppins-Light", 400: "Poppins-Regular", 600: "Poppins-SemiBold"}
+# Characters the templates print: Latin-1, ₹, dashes, quotes, bullet, ellipsis, ×
+FONT_UNICODES = [*range(0x20, 0x7F), *range(0xA0, 0x100), 0x20B9, 0x2013, 0x2014,
+                 0x2018, 0x2019, 0x201C, 0x201D, 0x2022, 0x2026, 0x00D7]
+
+def img_b64(path, height=None):
+    """Base64 PNG of an image file, or None if it's missing. With height (CSS px)
+    it is downscaled to twice that — enough for print — when larger."""
+    if not os.path.exists(path):
+        return None
+    return _encode_image(path, height, os.path.getmtime(path))
+
+@st.cache_resource(show_spinner=False)
+def _encode_image(path, height, mtime):
+    with open(path, "rb") as f:
+        raw = f.read()
+    if height:
+        try:
+            from PIL import Image
+            img = Image.open(io.BytesIO(raw))
+            if img.height > 2 * height:
+                img.thumbnail((img.width, 2 * height), Image.LANCZOS)
+                out = io.BytesIO()
+                img.save(out, format="PNG", optimize=True)
+                raw = out.getvalue()
+        except Exception:
+            pass   # keep the original bytes
+    return base64.b64encode(raw).decode()
 
-    # Build the content block
-    if mime == "application/pdf":
-        source_block = {"type": "base64", "media_type": "application/pdf", "data": file_b64}
-        content_type = "document"
-    else:
-        source_block = {"type": "base64", "media_type": mime, "data": file_b64}
-        content_type = "image"
+def _subset_font(raw):
+    """Cut a font down to FONT_UNICODES when fontTools is installed."""
+    try:
+        from fontTools import subset
+        from fontTools.ttLib import TTFont
+    except ImportError:
+        return raw
+    font = TTFont(io.BytesIO(raw))
+    sub  = subset.Subsetter()
+    sub.populate(unicodes=FONT_UNICODES)
+    sub.subset(font)
+    out = io.BytesIO()
+    font.save(out)
+    return out.getvalue()
+
+@st.cache_resource(show_spinner=False)
+def font_face_css():
+    """@font-face rules embedding the bundled Poppins files in FONT_DIR as data
+    URIs. A missing face is left out, and the templates fall back to a system
+    sans-serif."""
+    rules = []
+    for weight, stem in FONT_FACES.items():
+        for ext, fmt in (("woff2", "woff2"), ("woff", "woff"), ("ttf", "truetype")):
+            path = os.path.join(FONT_DIR, f"{stem}.{ext}")
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                raw = f.read()
+            if ext == "ttf":
+                raw = _subset_font(raw)
+            rules.append(f"@font-face{{font-family:'Poppins';font-weight:{weight};"
+                         f"src:url(data:font/{ext};base64,{base64.b64encode(raw).decode()}) format('{fmt}');}}")
+            break
+    return "\n".join(rules)
+
+def warm_assets():
+    img_b64(LOGO_PATH, LOGO_HEIGHT)
+    font_face_css()
 
-    prompt = """Extract all BOQ / work order data from this document and return ONLY a JSON object with this exact structure:
+# ── AI Extraction ──────────────────────────────────────────────────────────────
+#
+# Parsed results are kept on disk as JSON under BOQ_CACHE_DIR, one file per
+# SHA-256 of the uploaded bytes and BOQ_PROMPT_VERSION, so the same file is only
+# ever paid for once. Bump the version whenever the prompt or model changes.
+# Long PDFs are read BOQ_CHUNK_PAGES pages at a time, side by side, and the
+# ranges are cached the same way, so a retry only pays for what failed.
+
+BOQ_MODEL          = "claude-opus-4-5"
+BOQ_PROMPT_VERSION = "3"
+BOQ_CACHE_DIR      = ".boq_cache"
+BOQ_MAX_TOKENS     = 8000
+BOQ_CHUNK_PAGES    = 4
+BOQ_WORKERS        = 3
+BOQ_PROMPT = """Extract all BOQ / work order data from this document and return ONLY a JSON object with this exact structure:
 {
   "project_name": "...",
   "client_name": "...",
@@ -261,17 +705,53 @@ Rules:
 - If project/client not visible, use empty string
 - Return ONLY the JSON, no explanation"""
 
+def _boq_cache_file(key):
+    path = dict(st.secrets.get("boq", {})).get("cache_dir", BOQ_CACHE_DIR)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, f"{key}.json")
+
+def _boq_cache_get(key):
+    try:
+        with open(_boq_cache_file(key), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _boq_cache_put(key, data):
+    path = _boq_cache_file(key)
+    tmp  = path + f".{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+class BoqTruncatedError(Exception):
+    """The model stopped at max_tokens before finishing the JSON."""
+
+def _boq_request(client, file_bytes, mime):
+    """One extraction call on an image or PDF; the parsed JSON."""
+    file_b64 = base64.b64encode(file_bytes).decode()
+
+    # Build the content block
+    if mime == "application/pdf":
+        source_block = {"type": "base64", "media_type": "application/pdf", "data": file_b64}
+        content_type = "document"
+    else:
+        source_block = {"type": "base64", "media_type": mime, "data": file_b64}
+        content_type = "image"
+
     response = client.messages.create(
-        model="claude-opus-4-5",
-        max_tokens=2000,
+        model=BOQ_MODEL,
+        max_tokens=BOQ_MAX_TOKENS,
         messages=[{
             "role": "user",
             "content": [
                 {"type": content_type, "source": source_block},
-                {"type": "text", "text": prompt},
+                {"type": "text", "text": BOQ_PROMPT},
             ],
         }],
     )
+    if getattr(response, "stop_reason", None) == "max_tokens":
+        raise BoqTruncatedError("extraction output was cut off")
 
     raw = response.content[0].text.strip()
     # Strip markdown code fences if present
@@ -281,12 +761,296 @@ Rules:
             raw = raw[4:]
     return json.loads(raw.strip())
 
+def _split_pdf(file_bytes, pages):
+    """[(first page, last page, PDF bytes)] in runs of up to `pages` pages."""
+    from pypdf import PdfReader, PdfWriter
+    reader = PdfReader(io.BytesIO(file_bytes))
+    chunks = []
+    for first in range(0, len(reader.pages), pages):
+        writer = PdfWriter()
+        for page in reader.pages[first:first + pages]:
+            writer.add_page(page)
+        buf = io.BytesIO()
+        writer.write(buf)
+        chunks.append((first + 1, min(first + pages, len(reader.pages)), buf.getvalue()))
+    return chunks
+
+def _boq_item_key(it):
+    def num(v):
+        try:
+            return float(v or 0)
+        except (TypeError, ValueError):
+            return str(v)
+    return (" ".join(str(it.get("description", "")).lower().split()), str(it.get("unit", "")).upper(),
+            num(it.get("qty")), num(it.get("rate") or it.get("supply_rate")))
+
+def _merge_boq(parts):
+    """Chunk results in page order as one: header fields from the first chunk
+    that has them, items in order. A row cut by a page break tends to come back
+    from both sides of it, so a chunk's first item is dropped when it repeats
+    the previous chunk's last; repeats anywhere else are real BOQ lines."""
+    merged = {"project_name": "", "client_name": "", "scope": "", "items": []}
+    for part in parts:
+        for k in ("project_name", "client_name", "scope"):
+            merged[k] = merged[k] or part.get(k, "") or ""
+        items = list(part.get("items", []))
+        if items and merged["items"] and _boq_item_key(items[0]) == _boq_item_key(merged["items"][-1]):
+            items = items[1:]
+        merged["items"].extend(items)
+    return merged
+
+def _extract_pages(client, file_sha, first, last, pdf_bytes):
+    """Extraction of pages first..last of a file, cached per range. A range
+    whose answer is cut off is halved and each half extracted on its own."""
+    key    = f"{file_sha}-p{first}-{last}-v{BOQ_PROMPT_VERSION}"
+    cached = _boq_cache_get(key)
+    if cached is not None:
+        return cached
+    try:
+        data = _boq_request(client, pdf_bytes, "application/pdf")
+    except BoqTruncatedError:
+        if first == last:
+            raise
+        data = _merge_boq([_extract_pages(client, file_sha, first + a - 1, first + b - 1, part)
+                           for a, b, part in _split_pdf(pdf_bytes, (last - first + 2) // 2)])
+    _boq_cache_put(key, data)
+    return data
+
+def extract_boq_from_file(uploaded_file, on_progress=None):
+    """Send image or PDF to Claude and extract structured BOQ / work order data.
+    A file extracted before with the same prompt version comes from the cache.
+    PDFs longer than [boq] chunk_pages go in page ranges, at most [boq] workers
+    at a time, and are merged; on_progress(done, total, merged so far) is
+    called as each range finishes. Ranges that fail are listed under
+    "warnings" and the rest is returned."""
+    file_bytes = uploaded_file.getvalue()
+    file_sha   = hashlib.sha256(file_bytes).hexdigest()
+    key        = f"{file_sha}-v{BOQ_PROMPT_VERSION}"
+    cached     = _boq_cache_get(key)
+    if cached is not None:
+        return cached
+
+    client = anthropic.Anthropic(api_key=st.secrets["anthropic"]["api_key"])
+    mime   = uploaded_file.type  # e.g. image/jpeg, image/png, application/pdf
+    cfg    = dict(st.secrets.get("boq", {}))
+    if mime != "application/pdf":
+        data = _boq_request(client, file_bytes, mime)
+        _boq_cache_put(key, data)
+        return data
+
+    chunks = _split_pdf(file_bytes, int(cfg.get("chunk_pages", BOQ_CHUNK_PAGES)))
+    if len(chunks) == 1:
+        return _extract_pages(client, file_sha, 1, chunks[0][1], file_bytes)
+
+    results, failed = {}, []
+    with _ctx_pool(int(cfg.get("workers", BOQ_WORKERS)), "boq") as pool:
+        futs = {pool.submit(_extract_pages, client, file_sha, a, b, part): (a, b) for a, b, part in chunks}
+        for done, fut in enumerate(as_completed(futs), 1):
+            a, b = futs[fut]
+            try:
+                results[a] = fut.result()
+            except Exception as e:
+                failed.append(f"pages {a}–{b}: {e}")
+            if on_progress:
+                on_progress(done, len(futs), _merge_boq([results[k] for k in sorted(results)]))
+    if not results:
+        raise RuntimeError("; ".join(failed))
+    data = _merge_boq([results[k] for k in sorted(results)])
+    if failed:
+        data["warnings"] = failed   # not cached — a retry redoes only these ranges
+    else:
+        _boq_cache_put(key, data)
+    return data
+
+# ── Local read replica ─────────────────────────────────────────────────────────
+
+# Optional SQLite mirror of the workbook. Enable with a [replica] block in
+# secrets: path = "replica.sqlite3", sync_seconds = 30 (optional).
+REPLICA_SCHEMA = {
+    "Documents":       DOC_HEADERS,
+    "Dispatches":      DISPATCH_HEADERS,
+    "Work_Orders":     WO_HEADERS,
+    "Clients":         CLIENT_HEADERS,
+    "Items":           ITEM_HEADERS,
+    "Terms_Templates": TEMPLATE_HEADERS,
+    "Managers":        MANAGER_HEADERS,
+    "Settings":        SETTINGS_HEADERS,
+}
+REPLICA_INDEXES = {
+    "Documents":   [("doc_id",), ("doc_type", "status")],
+    "Dispatches":  [("dispatch_id",), ("status",)],
+    "Work_Orders": [("wo_id",)],
+}
+
+def _q(name):
+    """Quote an SQLite identifier (sheet titles and headers are used verbatim)."""
+    return '"' + name.replace('"', '""') + '"'
+
+class _Replica:
+    """SQLite mirror of the workbook, one table per worksheet.
+
+    Each row keeps its sheet row number in _row and a digest of its cells in
+    _hash, so a sync only rewrites rows that changed. Cells are stored as the
+    strings Sheets returns; _to_records() numericises them like a live read.
+    The _sync table holds the per-sheet watermark: when the sheet was last read
+    or, by a sync round's probe, confirmed unchanged."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self._gen = {}   # write-through count per sheet, see sync()
+        self._create()
+
+    def _create(self):
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS _sync (tbl TEXT PRIMARY KEY, synced_at TEXT, row_count INTEGER)")
+            for t, headers in REPLICA_SCHEMA.items():
+                cols = [r[1] for r in self.conn.execute(f"PRAGMA table_info({_q(t)})")]
+                if cols and cols != ["_row", "_hash"] + headers:
+                    # Headers changed since this table was built — start it over
+                    self.conn.execute(f"DROP TABLE {_q(t)}")
+                    self.conn.execute("DELETE FROM _sync WHERE tbl = ?", (t,))
+                self.conn.execute(f"CREATE TABLE IF NOT EXISTS {_q(t)} (_row INTEGER PRIMARY KEY, _hash TEXT, "
+                                  + ", ".join(_q(h) for h in headers) + ")")
+                for cols in REPLICA_INDEXES.get(t, []):
+                    name = _q(f"ix_{t}_" + "_".join(cols))
+                    self.conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {_q(t)} ({', '.join(_q(c) for c in cols)})")
+
+    def rebuild(self):
+        """Drop everything; the next sync reloads every sheet from scratch."""
+        with self.lock, self.conn:
+            for t in REPLICA_SCHEMA:
+                self.conn.execute(f"DROP TABLE IF EXISTS {_q(t)}")
+            self.conn.execute("DROP TABLE IF EXISTS _sync")
+        self._create()
+
+    def watermark(self, tables=None):
+        """Oldest last-sync time across the given sheets; None if any was never synced."""
+        tables = list(tables or REPLICA_SCHEMA)
+        with self.lock:
+            synced = dict(self.conn.execute("SELECT tbl, synced_at FROM _sync").fetchall())
+        if any(t not in synced for t in tables):
+            return None
+        return min(synced[t] for t in tables)
+
+    def confirm(self, when):
+        """Advance every synced sheet's watermark to `when` (ISO): a probe then
+        found nothing to read."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE _sync SET synced_at = ? WHERE synced_at < ?", (when, when))
+
+    def generation(self):
+        with self.lock:
+            return dict(self._gen)
+
+    def values(self, table):
+        """Header row + data rows, shaped like a values_batch_get range."""
+        headers = REPLICA_SCHEMA[table]
+        cols    = ", ".join(_q(h) for h in headers)
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {cols} FROM {_q(table)} ORDER BY _row").fetchall()
+        return [headers] + [list(r) for r in rows]
+
+    def query(self, table, newest_first=True, **where):
+        """Records whose columns equal the given values, via the table's indexes."""
+        headers = REPLICA_SCHEMA[table]
+        sql     = f"SELECT {', '.join(_q(h) for h in headers)} FROM {_q(table)}"
+        if where:
+            sql += " WHERE " + " AND ".join(f"{_q(k)} = ?" for k in where)
+        sql += " ORDER BY _row" + (" DESC" if newest_first else "")
+        with self.lock:
+            rows = self.conn.execute(sql, [str(v) for v in where.values()]).fetchall()
+        return _to_records([headers] + [list(r) for r in rows])
+
+    def _apply(self, table, rows):
+        headers = REPLICA_SCHEMA[table]
+        width   = len(headers)
+        have    = dict(self.conn.execute(f"SELECT _row, _hash FROM {_q(table)}").fetchall())
+        upserts = []
+        for i, row in enumerate(rows):
+            row = ["" if c is None else str(c) for c in row[:width]]
+            row += [""] * (width - len(row))
+            digest = hashlib.sha1("\x1f".join(row).encode()).hexdigest()
+            if have.get(i + 2) != digest:
+                upserts.append([i + 2, digest] + row)
+        dropped = self.conn.execute(f"DELETE FROM {_q(table)} WHERE _row >= ?", (len(rows) + 2,)).rowcount
+        if upserts:
+            self.conn.executemany(f"INSERT OR REPLACE INTO {_q(table)} VALUES ({', '.join('?' * (width + 2))})", upserts)
+        return bool(upserts or dropped)
+
+    def sync(self, values, gens=None):
+        """Apply freshly read worksheet values and advance the watermark.
+
+        gens is generation() taken before the values were read: a sheet written
+        through since then is skipped, so a slow read can't undo a newer write.
+        Returns the sheets whose rows changed."""
+        changed = []
+        now     = datetime.now().isoformat()
+        with self.lock, self.conn:
+            for t, v in values.items():
+                if t not in REPLICA_SCHEMA:
+                    continue
+                if gens is not None and self._gen.get(t, 0) != gens.get(t, 0):
+                    continue
+                if self._apply(t, v[1:]):
+                    changed.append(t)
+                self.conn.execute("INSERT OR REPLACE INTO _sync VALUES (?, ?, ?)", (t, now, max(len(v) - 1, 0)))
+        return changed
+
+    def mirror(self, table, records):
+        """Write-through: replace a sheet's rows with the snapshot's records."""
+        headers = REPLICA_SCHEMA[table]
+        with self.lock, self.conn:
+            self._gen[table] = self._gen.get(table, 0) + 1
+            self._apply(table, [[r.get(h, "") for h in headers] for r in records])
+
+@st.cache_resource
+def _replica():
+    """The SQLite replica and its background sync thread; None unless [replica] is configured."""
+    cfg = dict(st.secrets.get("replica", {}))
+    if not cfg.get("path"):
+        return None
+    rep      = _Replica(cfg["path"])
+    db       = _storage()
+    interval = float(cfg.get("sync_seconds", 30))
+    full_gap = float({**CACHE_DEFAULTS, **dict(st.secrets.get("cache", {}))}["full_refresh_seconds"])
+
+    def sync_loop():
+        # Each round probes like the snapshot does (see _Snapshot.refresh) and
+        # reads only the sheets whose stamp moved; everything on the first round,
+        # after an unexplained modified-time move and every full_refresh_seconds.
+        # Settings has no stamp, so only those full reads pick its changes up.
+        if rep.watermark() is None:
+            time.sleep(interval)   # first page load is reading Sheets and filling the replica
+        stamps, modified, full_at = None, None, 0.0
+        while True:
+            try:
+                now    = time.monotonic()
+                probed = datetime.now().isoformat()
+                mod    = _probe_modified(db)
+                latest = _read_versions(db)
+                if (stamps is None or now - full_at >= full_gap
+                        or (latest == stamps and None not in (mod, modified) and mod != modified)):
+                    titles, full_at = list(REPLICA_SCHEMA), now
+                else:
+                    titles = [t for t in REPLICA_SCHEMA if latest.get(t, "") != stamps.get(t, "")]
+                if titles:
+                    gens = rep.generation()
+                    if rep.sync(_read_sheets_remote(titles, db), gens):
+                        _fetch_snapshot.clear()
+                        _fetch_settings.clear()
+                rep.confirm(probed)
+                stamps, modified = latest, mod
+            except Exception:
+                pass   # Sheets unreachable — keep serving the replica, retry next round
+            time.sleep(interval)
+
+    threading.Thread(target=sync_loop, name="replica-sync", daemon=True).start()
+    return rep
+
 # ── Sheets CRUD ────────────────────────────────────────────────────────────────
 
 def save_document(data, edit_id=None):
-    sh = get_sheet()
-    ws = sh.worksheet("Documents")
-    records = _fetch_documents()
     token = make_token(data["doc_id"])
     row = [
         data["doc_id"], data["doc_type"], data.get("status", "Draft"),
@@ -298,79 +1062,426 @@ def save_document(data, edit_id=None):
         data.get("created_at", datetime.now().isoformat()),
         token, "", "", "", data.get("notes", ""), data.get("doc_code", ""),
         data.get("vehicle_no", ""), data.get("transporter_name", ""),
-        data.get("distance_km", ""), data.get("transport_mode", "Road"),
+        data.get("distance_km", ""), data.get("transport_mode", "Road"), "",
     ]
-    if edit_id:
-        for i, r in enumerate(records):
-            if r["doc_id"] == edit_id:
-                ws.update(f"A{i+2}:X{i+2}", [row])
-                _bust()
-                return data["doc_id"]
-    ws.append_row(row)
-    _bust()
+    snap = _fetch_snapshot()
+    hit  = snap.index("Documents").get(edit_id) if edit_id else None
+    if hit:
+        n, _ = hit
+        _sheet_update("Documents", f"A{n}:Y{n}", [row], snap)
+        return data["doc_id"]
+    _sheet_append("Documents", row, snap)
     return data["doc_id"]
 
-@st.cache_data(ttl=60)
+# Data worksheets served by the _fetch_* helpers. A cold cache reads all of
+# them in a single values_batch_get round trip instead of one call per sheet.
+SNAPSHOT_SHEETS = ["Documents", "Terms_Templates", "Managers", "Clients",
+                   "Items", "Work_Orders", "Dispatches"]
+
+# Change detection. Each write through the _sheet_* helpers stamps its sheet's
+# row in _Versions, in the same request when it can. Every ttl_seconds the
+# snapshot reads just that small range and re-reads only the sheets whose stamp
+# moved. Edits made by hand in the Sheets UI (managers, PINs) don't stamp
+# anything, but they do move the workbook's Drive modified time, which is
+# probed alongside: a move that no stamp and no write of ours explains re-reads
+# everything. full_refresh_seconds remains as a backstop. The check runs
+# in a background thread while readers keep getting the current copy; only
+# data older than hard_expiry_seconds makes a rerun wait. All three are
+# overridable in a [cache] secrets section.
+VERSIONS_SHEET = "_Versions"
+CACHE_DEFAULTS = {"ttl_seconds": 60, "hard_expiry_seconds": 300, "full_refresh_seconds": 600}
+
+def _version_cell(title):
+    return f"B{SNAPSHOT_SHEETS.index(title) + 2}"
+
+def _new_version():
+    return f"{time.time_ns():x}{os.getpid():x}"
+
+def _parse_versions(values):
+    return {r[0]: (r[1] if len(r) > 1 else "") for r in values[1:] if r}
+
+def _read_versions(db=None):
+    """{sheet: stamp} — one small read, the cheap freshness probe."""
+    return _parse_versions((db or _storage()).batch_get([f"'{VERSIONS_SHEET}'!A1:B"])[0])
+
+def _probe_modified(db=None):
+    """The workbook's last-modified time, or None when Drive can't be asked."""
+    try:
+        return (db or _storage()).modified_time()
+    except Exception:
+        return None
+
+def _to_records(values):
+    """Turn a raw values block (header row first) into get_all_records() dicts."""
+    if not values:
+        return []
+    rows = fill_gaps(values)
+    keys = rows[0]
+    return [dict(zip(keys, numericise_all(r))) for r in rows[1:]]
+
+def _cell(v):
+    """The value get_all_records() would read back for a cell we just wrote."""
+    return numericise_all(["" if v is None else str(v)])[0]
+
+def _read_sheets_remote(titles, db=None):
+    """Whole-worksheet values for several sheets in one batched read.
+    The _Versions range rides along, so the stamps match the data read."""
+    titles = list(titles) + [VERSIONS_SHEET]
+    values = (db or _storage()).batch_get([f"'{t}'" for t in titles])
+    return dict(zip(titles, values))
+
+def _read_sheets(titles, fresh=False):
+    """Worksheet values, served from the local replica once it has synced them.
+    fresh=True (or no replica) reads Sheets and refreshes the replica too."""
+    rep = _replica()
+    if rep and not fresh and rep.watermark(titles):
+        return {t: rep.values(t) for t in titles}
+    gens = rep.generation() if rep else None
+    values = _read_sheets_remote(titles)
+    if rep:
+        rep.sync(values, gens)
+    return values
+
+def _mirror(snap, title):
+    """Copy a written-through table into the replica, if there is one."""
+    rep = _replica()
+    if rep and title in REPLICA_SCHEMA:
+        rep.mirror(title, snap.tables.get(title, []))
+
+# Primary key column of each worksheet that gets a row index on the snapshot
+ROW_KEYS = {"Documents": "doc_id", "Dispatches": "dispatch_id", "Work_Orders": "wo_id"}
+
+class _Snapshot:
+    """Records of every data worksheet plus primary-key row indexes.
+
+    Writes are applied here as well as to the sheet (write-through), so a save
+    is visible on the next rerun without re-reading anything. A table that
+    can't be patched in memory is marked stale and only that worksheet is
+    re-read. Tables are copy-on-write: every change swaps in a new list, so a
+    caller still iterating the old one never sees it change underneath it.
+
+    Freshness is checked against the _Versions stamps (see _read_versions)
+    stale-while-revalidate: readers are served the current copy while a
+    background thread re-reads whatever changed. Unchanged sheets keep their
+    records."""
+
+    def __init__(self, values, ttl=60, hard_expiry=300, full_refresh=600, modified=None):
+        self.tables       = {}
+        self.headers      = {}
+        self.versions     = {}
+        self._indexes     = {}
+        self._stale       = set()
+        self._lock        = threading.RLock()
+        self.ttl          = ttl
+        self.hard_expiry  = hard_expiry
+        self.full_refresh = full_refresh
+        self.confirmed_at = self.attempted_at = self.loaded_at = time.monotonic()
+        self.as_of        = datetime.now()   # wall-clock time the data was last known current
+        self._refreshing  = False
+        self.modified     = modified   # workbook modified time as of the data held
+        self._wrote       = False      # stamped a write of ours since the last probe
+        self._load(values)
+
+    def _load(self, values):
+        stamps = _parse_versions(values[VERSIONS_SHEET]) if VERSIONS_SHEET in values else {}
+        for t, v in values.items():
+            if t == VERSIONS_SHEET:
+                continue
+            self.tables[t]   = _to_records(v)
+            self.headers[t]  = fill_gaps(v)[0] if v else []
+            self.versions[t] = stamps.get(t, "")
+            self._indexes.pop(t, None)
+            self._stale.discard(t)
+
+    def _check(self):
+        """Start a background refresh once the data is ttl old; past hard_expiry, wait for one."""
+        now = time.monotonic()
+        age = now - self.confirmed_at
+        if age < self.ttl:
+            return
+        rep = _replica()
+        if rep:
+            # The replica's sync thread clears the snapshot on change, and its
+            # watermark is when that thread last confirmed the data
+            synced = rep.watermark(SNAPSHOT_SHEETS)
+            with self._lock:
+                self.confirmed_at = now
+                if synced:
+                    self.as_of = max(self.as_of, datetime.fromisoformat(synced))
+            return
+        with self._lock:
+            if self._refreshing or now - self.attempted_at < self.ttl / 4:
+                return   # one in flight, or the last attempt just failed
+            self.attempted_at = now
+            if age >= self.hard_expiry:
+                try:
+                    self.refresh()
+                except Exception:
+                    pass   # Sheets is unreachable: serving old data beats an error page
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, args=(_storage(), True),
+                         name="snapshot-refresh", daemon=True).start()
+
+    def refresh(self, db=None, background=False):
+        """Probe the version stamps and the workbook's modified time, and re-read
+        the sheets that moved — all of them after a hand edit, and every
+        full_refresh. Reads happen outside the lock, and a sheet this process
+        writes to meanwhile is left alone — its records are newer."""
+        db = db or _storage()
+        try:
+            started = time.monotonic()
+            with self._lock:
+                before, wrote, self._wrote = dict(self.versions), self._wrote, False
+            modified = _probe_modified(db)
+            full     = started - self.loaded_at >= self.full_refresh
+            if full:
+                changed = list(self.tables)
+            else:
+                latest  = _read_versions(db)
+                changed = [t for t in self.tables if latest.get(t, "") != before.get(t)]
+                if not changed and not wrote and None not in (modified, self.modified) and modified != self.modified:
+                    full, changed = True, list(self.tables)   # edited by hand in the Sheets UI
+            values = _read_sheets_remote(changed, db) if changed else {}
+            with self._lock:
+                for t in changed:
+                    if self.versions.get(t) != before.get(t):
+                        values.pop(t)
+                self._load(values)
+                if full:
+                    self.loaded_at = started
+                if modified is not None:
+                    self.modified = modified
+                self.confirmed_at = started
+                self.as_of        = datetime.now()
+        except Exception:
+            if not background:
+                raise
+        finally:
+            if background:
+                self._refreshing = False
+
+    def stamp(self, title, version):
+        """Record a version this process just wrote, so it isn't mistaken for a change."""
+        with self._lock:
+            self.versions[title] = version
+            self._wrote = True
+
+    def table(self, name):
+        self._check()
+        if self._stale:
+            self.revalidate()
+        return self.tables.get(name, [])
+
+    def index(self, table):
+        """{key: (sheet row number, record)} — built once per snapshot."""
+        self._check()
+        if self._stale:
+            self.revalidate()
+        idx = self._indexes.get(table)
+        if idx is None:
+            with self._lock:
+                idx = self._indexes.get(table)
+                if idx is None:
+                    key = ROW_KEYS[table]
+                    idx = {}
+                    for i, r in enumerate(self.tables.get(table, [])):
+                        idx.setdefault(r[key], (i + 2, r))   # first match wins, like a scan
+                    self._indexes[table] = idx
+        return idx
+
+    def invalidate(self, *tables):
+        with self._lock:
+            self._stale.update(tables)
+
+    def revalidate(self):
+        """Re-read just the stale worksheets, in one batched call."""
+        with self._lock:
+            if self._stale:
+                self._load(_read_sheets(sorted(self._stale), fresh=True))
+
+    def _reindex(self, table, n, old, new):
+        idx = self._indexes.get(table)
+        if idx is None:
+            return
+        key = ROW_KEYS[table]
+        if old is not None and idx.get(old[key], (None,))[0] == n:
+            del idx[old[key]]
+        idx.setdefault(new[key], (n, new))
+
+    def write(self, table, a1, values):
+        """Mirror ws.update(a1, values) onto the in-memory table."""
+        grid = a1_range_to_grid_range(a1)
+        r0   = grid.get("startRowIndex", 0)
+        c0   = grid.get("startColumnIndex", 0)
+        with self._lock:
+            rows    = list(self.tables.get(table, []))
+            headers = self.headers.get(table, [])
+            for dr, vals in enumerate(values):
+                n = r0 + dr + 1
+                if n == 1:
+                    continue   # header row
+                if n - 2 >= len(rows):
+                    self._stale.add(table)
+                    return
+                old = rows[n - 2]
+                rec = dict(old)
+                for dc, v in enumerate(vals):
+                    if c0 + dc < len(headers) and headers[c0 + dc]:
+                        rec[headers[c0 + dc]] = _cell(v)
+                rows[n - 2] = rec
+                self._reindex(table, n, old, rec)
+            self.tables[table] = rows
+
+    def append(self, table, new_rows, n=None):
+        """Mirror ws.append_rows(new_rows); n is the first sheet row the API reported."""
+        with self._lock:
+            rows    = self.tables.get(table, [])
+            headers = self.headers.get(table, [])
+            if not headers or (n is not None and n != len(rows) + 2):
+                self._stale.add(table)   # gap or a concurrent append — re-read this sheet
+                return
+            added = []
+            for row in new_rows:
+                row = list(row) + [""] * (len(headers) - len(row))
+                added.append({h: _cell(v) for h, v in zip(headers, row)})
+            self.tables[table] = rows + added
+            for i, rec in enumerate(added):
+                self._reindex(table, len(rows) + 2 + i, None, rec)
+
+    def delete(self, table, n):
+        """Drop sheet row n; index entries below it move up one row."""
+        with self._lock:
+            rows = self.tables.get(table, [])
+            self.tables[table] = rows[:n - 2] + rows[n - 1:]
+            idx = self._indexes.get(table)
+            if idx is not None:
+                for k, (row, rec) in list(idx.items()):
+                    if row == n:
+                        del idx[k]
+                    elif row > n:
+                        idx[k] = (row - 1, rec)
+
+@st.cache_resource
+def _fetch_snapshot():
+    """One batched read of every data worksheet, kept fresh by _Snapshot._check.
+    Shared across sessions and returned by reference — callers must not mutate records."""
+    cfg      = {**CACHE_DEFAULTS, **dict(st.secrets.get("cache", {}))}
+    modified = None if _replica() else _probe_modified()   # before the read, so nothing slips between
+    return _Snapshot(_read_sheets(SNAPSHOT_SHEETS), ttl=float(cfg["ttl_seconds"]),
+                     hard_expiry=float(cfg["hard_expiry_seconds"]),
+                     full_refresh=float(cfg["full_refresh_seconds"]), modified=modified)
+
+def data_as_of():
+    """When the shared snapshot was last confirmed current."""
+    return _fetch_snapshot().as_of
+
+def _find_row(table, key):
+    """(sheet row number, record) for a primary key, or None. O(1)."""
+    return _fetch_snapshot().index(table).get(key)
+
+def _bump_version(title, snap):
+    """Stamp a sheet as changed after a write that couldn't carry the stamp itself."""
+    version = _new_version()
+    try:
+        _storage().update(VERSIONS_SHEET, _version_cell(title), [[version]])
+    except Exception:
+        return   # other processes pick the change up on their next full refresh
+    snap.stamp(title, version)
+
+def _sheet_update(title, a1, values, snap=None):
+    """ws.update() written through to the snapshot."""
+    _sheet_batch_update(title, [(a1, values)], snap)
+
+def _sheet_batch_update(title, updates, snap=None):
+    """Several [(a1, values), ...] writes sent as one request together with the
+    sheet's version stamp, so they all land or none do; written through to the snapshot."""
+    snap    = snap or _fetch_snapshot()
+    version = _new_version()
+    try:
+        _storage().batch_write([(title, a1, v) for a1, v in updates]
+                               + [(VERSIONS_SHEET, _version_cell(title), [[version]])])
+    except Exception:
+        snap.invalidate(title)   # the write may or may not have landed
+        raise
+    for a1, v in updates:
+        snap.write(title, a1, v)
+    snap.stamp(title, version)
+    _mirror(snap, title)
+
+def _sheet_append(title, row, snap=None):
+    """ws.append_row() written through to the snapshot."""
+    _sheet_append_rows(title, [row], snap)
+
+def _sheet_append_rows(title, rows, snap=None):
+    """ws.append_rows() written through to the snapshot."""
+    snap = snap or _fetch_snapshot()
+    try:
+        n = _storage().append_rows(title, rows)
+    except Exception:
+        snap.invalidate(title)
+        raise
+    snap.append(title, rows, n)
+    _bump_version(title, snap)
+    _mirror(snap, title)
+
+def _a1(headers, col, n):
+    """A1 address of a named column on sheet row n."""
+    return rowcol_to_a1(n, headers.index(col) + 1)
+
 def _fetch_documents():
-    return get_sheet().worksheet("Documents").get_all_records()
+    return _fetch_snapshot().table("Documents")
 
-@st.cache_data(ttl=60)
 def _fetch_templates():
-    return get_sheet().worksheet("Terms_Templates").get_all_records()
+    return _fetch_snapshot().table("Terms_Templates")
 
-@st.cache_data(ttl=60)
 def _fetch_managers():
-    return get_sheet().worksheet("Managers").get_all_records()
+    return _fetch_snapshot().table("Managers")
 
-@st.cache_data(ttl=60)
 def _fetch_clients():
-    return get_sheet().worksheet("Clients").get_all_records()
+    return _fetch_snapshot().table("Clients")
 
-@st.cache_data(ttl=60)
 def _fetch_items():
-    return get_sheet().worksheet("Items").get_all_records()
+    return _fetch_snapshot().table("Items")
 
-@st.cache_data(ttl=60)
 def _fetch_work_orders():
-    return get_sheet().worksheet("Work_Orders").get_all_records()
+    return _fetch_snapshot().table("Work_Orders")
 
 @st.cache_data(ttl=300)
 def _fetch_settings():
-    rows = get_sheet().worksheet("Settings").get_all_records()
+    rows = _to_records(_read_sheets(["Settings"])["Settings"])
     return {r["key"]: r["value"] for r in rows if r.get("key")}
 
 def get_settings():
     return _fetch_settings()
 
 def save_settings(kv_dict):
-    ws   = get_sheet().worksheet("Settings")
-    rows = ws.get_all_records()
+    """Write every key in one batch_update; new keys go below the last row."""
+    db   = _storage()
+    rows = _to_records(_read_sheets_remote(["Settings"], db)["Settings"])
     key_to_row = {r["key"]: i + 2 for i, r in enumerate(rows)}
+    updates, new_rows = [], []
     for k, v in kv_dict.items():
         if k in key_to_row:
-            ws.update(f"B{key_to_row[k]}", [[v]])
+            updates.append((f"B{key_to_row[k]}", [[v]]))
         else:
-            ws.append_row([k, v])
+            new_rows.append([k, v])
+    next_row = len(rows) + 2
+    if new_rows and next_row + len(new_rows) - 1 <= db.size("Settings")[0]:
+        updates.append((f"A{next_row}:B{next_row + len(new_rows) - 1}", new_rows))
+        new_rows = []
+    if updates:
+        db.batch_update("Settings", updates)
+    if new_rows:
+        db.append_rows("Settings", new_rows)   # grid is full — only the append can grow it
+    if _replica():
+        _read_sheets(["Settings"], fresh=True)
     _fetch_settings.clear()
 
-def _bust():
-    """Clear all data caches after any write."""
-    _fetch_documents.clear()
-    _fetch_templates.clear()
-    _fetch_managers.clear()
-    _fetch_clients.clear()
-    _fetch_items.clear()
-    _fetch_work_orders.clear()
-    _fetch_dispatches.clear()
-
 # ── Dispatch CRUD ───────────────────────────────────────────────────────────────
 
-@st.cache_data(ttl=60)
 def _fetch_dispatches():
-    try:
-        return get_sheet().worksheet("Dispatches").get_all_records()
-    except Exception:
-        return []
+    return _fetch_snapshot().table("Dispatches")
 
 def generate_dispatch_id():
     year  = datetime.now().strftime("%Y")
@@ -379,9 +1490,6 @@ def generate_dispatch_id():
     return f"DISP-{year}-{count:03d}"
 
 def save_dispatch(data, edit_id=None):
-    sh = get_sheet()
-    ws = sh.worksheet("Dispatches")
-    records = _fetch_dispatches()
     row = [
         data["dispatch_id"],
         data.get("source_doc_id", ""),
@@ -397,79 +1505,106 @@ def save_dispatch(data, edit_id=None):
         json.dumps(data.get("items", [])),
         data.get("created_at", datetime.now().isoformat()),
         data.get("finalized_at", ""),
+        data.get("pdf_sha256", ""),
     ]
-    if edit_id:
-        for i, r in enumerate(records):
-            if r["dispatch_id"] == edit_id:
-                ws.update(f"A{i+2}:N{i+2}", [row])
-                _bust()
-                return data["dispatch_id"]
-    ws.append_row(row)
-    _bust()
+    snap = _fetch_snapshot()
+    hit  = snap.index("Dispatches").get(edit_id) if edit_id else None
+    if hit:
+        n, _ = hit
+        _sheet_update("Dispatches", f"A{n}:O{n}", [row], snap)
+        return data["dispatch_id"]
+    _sheet_append("Dispatches", row, snap)
     return data["dispatch_id"]
 
+def _parse_dispatch(r):
+    r = dict(r)
+    try:
+        r["items"] = json.loads(r["items_json"])
+    except Exception:
+        r["items"] = []
+    return r
+
 def get_dispatch(dispatch_id):
-    for r in _fetch_dispatches():
-        if r["dispatch_id"] == dispatch_id:
-            r = dict(r)
-            try:
-                r["items"] = json.loads(r["items_json"])
-            except Exception:
-                r["items"] = []
-            return r
-    return None
+    hit = _find_row("Dispatches", dispatch_id)
+    return _parse_dispatch(hit[1]) if hit else None
 
 def get_dispatches():
-    result = []
-    for r in _fetch_dispatches():
-        r = dict(r)
-        try:
-            r["items"] = json.loads(r["items_json"])
-        except Exception:
-            r["items"] = []
-        result.append(r)
-    return result
+    return [_parse_dispatch(r) for r in _fetch_dispatches()]
+
+def challan_data(disp):
+    """The Challan document build_html_challan() prints for a dispatch."""
+    return {
+        "doc_id":           disp["dispatch_id"],
+        "doc_type":         "Challan",
+        "client_name":      disp.get("client_name",""),
+        "project_name":     disp.get("project_name",""),
+        "billing_address":  disp.get("billing_address",""),
+        "delivery_address": disp.get("delivery_address",""),
+        "doc_date":         str(disp.get("finalized_at","") or disp.get("created_at",""))[:10],
+        "vehicle_no":       disp.get("vehicle_no",""),
+        "transporter_name": disp.get("transporter_name",""),
+        "transport_mode":   disp.get("transport_mode","Road"),
+        "notes":            disp.get("purpose","Supply"),
+        "items":            disp.get("items",[]),
+    }
+
+def find_dispatches(status="All"):
+    """Dispatches newest first, optionally by status — an indexed query on the replica."""
+    rep = _replica()
+    if rep and rep.watermark(["Dispatches"]):
+        rows = rep.query("Dispatches", **({"status": status} if status != "All" else {}))
+    else:
+        rows = [r for r in reversed(_fetch_dispatches()) if status == "All" or r.get("status") == status]
+    return [_parse_dispatch(r) for r in rows]
 
 def delete_dispatch(dispatch_id):
-    ws = get_sheet().worksheet("Dispatches")
-    records = _fetch_dispatches()
-    for i, r in enumerate(records):
-        if r["dispatch_id"] == dispatch_id:
-            ws.delete_rows(i + 2)
-            _bust()
-            return True
-    return False
+    snap = _fetch_snapshot()
+    hit  = snap.index("Dispatches").get(dispatch_id)
+    if not hit:
+        return False
+    n, _ = hit
+    _storage().delete_row("Dispatches", n)
+    snap.delete("Dispatches", n)
+    _bump_version("Dispatches", snap)
+    _mirror(snap, "Dispatches")
+    return True
 
 def get_document(doc_id):
-    for r in _fetch_documents():
-        if r["doc_id"] == doc_id:
-            r = dict(r)
-            try:
-                r["items"] = json.loads(r["items_json"])
-            except Exception:
-                r["items"] = []
-            try:
-                r["terms"] = json.loads(r["terms_json"])
-            except Exception:
-                r["terms"] = []
-            return r
-    return None
+    hit = _find_row("Documents", doc_id)
+    if not hit:
+        return None
+    r = dict(hit[1])
+    try:
+        r["items"] = json.loads(r["items_json"])
+    except Exception:
+        r["items"] = []
+    try:
+        r["terms"] = json.loads(r["terms_json"])
+    except Exception:
+        r["terms"] = []
+    return r
 
 def all_documents():
     return _fetch_documents()
 
+def find_documents(doc_type="All", status="All"):
+    """Documents newest first, optionally by type/status — an indexed query on the replica."""
+    where = {k: v for k, v in (("doc_type", doc_type), ("status", status)) if v != "All"}
+    rep   = _replica()
+    if rep and rep.watermark(["Documents"]):
+        return rep.query("Documents", **where)
+    return [d for d in reversed(_fetch_documents()) if all(d.get(k) == v for k, v in where.items())]
+
 def get_templates():
     return {r["name"]: json.loads(r["terms_json"]) for r in _fetch_templates() if r.get("name")}
 
 def save_template(name, terms):
-    ws = get_sheet().worksheet("Terms_Templates")
-    for i, r in enumerate(_fetch_templates()):
+    snap = _fetch_snapshot()
+    for i, r in enumerate(snap.table("Terms_Templates")):
         if r["name"] == name:
-            ws.update(f"A{i+2}:B{i+2}", [[name, json.dumps(terms)]])
-            _bust()
+            _sheet_update("Terms_Templates", f"A{i+2}:B{i+2}", [[name, json.dumps(terms)]], snap)
             return
-    ws.append_row([name, json.dumps(terms)])
-    _bust()
+    _sheet_append("Terms_Templates", [name, json.dumps(terms)], snap)
 
 def get_managers():
     return _fetch_managers()
@@ -478,36 +1613,39 @@ def get_clients():
     return _fetch_clients()
 
 def save_client(data, edit_idx=None):
-    ws = get_sheet().worksheet("Clients")
     row = [data["name"], data["billing_address"], data["delivery_address"],
-           data["gst_number"], data["payment_terms"], data["notes"]]
+           data["gst_number"], data["payment_terms"], data["notes"],
+           data.get("email", ""), data.get("contact_name", "")]
     if edit_idx is not None:
-        ws.update(f"A{edit_idx+2}:F{edit_idx+2}", [row])
+        _sheet_update("Clients", f"A{edit_idx+2}:H{edit_idx+2}", [row])
     else:
-        ws.append_row(row)
-    _bust()
+        _sheet_append("Clients", row)
 
 def get_items():
     return _fetch_items()
 
+def _item_row(data):
+    return [data["item_code"], data["description"], data["unit"],
+            float(data.get("base_rate", 0)), data["category"],
+            json.dumps(data.get("sale_types", ["Supply", "Installation"])),
+            float(data.get("supply_rate", data.get("base_rate", 0))),
+            float(data.get("installation_rate", 0))]
+
 def save_item(data, edit_idx=None):
-    ws = get_sheet().worksheet("Items")
-    row = [data["item_code"], data["description"], data["unit"],
-           float(data.get("base_rate", 0)), data["category"],
-           json.dumps(data.get("sale_types", ["Supply", "Installation"])),
-           float(data.get("supply_rate", data.get("base_rate", 0))),
-           float(data.get("installation_rate", 0))]
-    if edit_idx is not None:
-        ws.update(f"A{edit_idx+2}:H{edit_idx+2}", [row])
-    else:
-        ws.append_row(row)
-    _bust()
+    save_items([(data, edit_idx)])
+
+def save_items(entries):
+    """Upsert [(data, edit_idx), ...] with one batch_update plus one append_rows."""
+    snap    = _fetch_snapshot()
+    updates = [(f"A{idx+2}:H{idx+2}", [_item_row(d)]) for d, idx in entries if idx is not None]
+    appends = [_item_row(d) for d, idx in entries if idx is None]
+    if updates:
+        _sheet_batch_update("Items", updates, snap)
+    if appends:
+        _sheet_append_rows("Items", appends, snap)
 
 # ── Work Orders ────────────────────────────────────────────────────────────────
 
-WO_HEADERS = ["wo_id", "client_name", "project_name", "scope",
-              "items_json", "milestones_json", "terms_json", "created_at", "status"]
-
 def get_work_orders():
     records = _fetch_work_orders()
     result  = []
@@ -534,45 +1672,40 @@ def generate_wo_id():
     return f"WO-{year}-{count:03d}"
 
 def save_work_order(data, edit_id=None):
-    ws  = get_sheet().worksheet("Work_Orders")
     row = [
         data["wo_id"], data["client_name"], data["project_name"], data["scope"],
         json.dumps(data["items"]), json.dumps(data["milestones"]),
         json.dumps(data.get("terms", [])),
         data.get("created_at", datetime.now().isoformat()), data.get("status", "Active"),
     ]
-    if edit_id:
-        for i, r in enumerate(_fetch_work_orders()):
-            if r["wo_id"] == edit_id:
-                ws.update(f"A{i+2}:I{i+2}", [row])
-                _bust()
-                return
-    ws.append_row(row)
-    _bust()
+    snap = _fetch_snapshot()
+    hit  = snap.index("Work_Orders").get(edit_id) if edit_id else None
+    if hit:
+        n, _ = hit
+        _sheet_update("Work_Orders", f"A{n}:I{n}", [row], snap)
+        return
+    _sheet_append("Work_Orders", row, snap)
 
 def update_wo_milestone(wo_id, milestone_idx, new_status):
-    ws = get_sheet().worksheet("Work_Orders")
-    for i, r in enumerate(_fetch_work_orders()):
-        if r["wo_id"] == wo_id:
-            milestones = json.loads(r["milestones_json"])
-            milestones[milestone_idx]["status"] = new_status
-            ws.update(f"F{i+2}", [[json.dumps(milestones)]])
-            _bust()
-            return
-
-def send_invoice_email(to_email, cc_emails, subject, body, pdf_bytes, pdf_filename):
-    """Send approved-invoice email with PDF attachment via SMTP.
-    SMTP creds read from st.secrets['smtp']: host, port, user, password, from_name (optional)."""
-    smtp_cfg = dict(st.secrets.get("smtp", {}))
-    if not smtp_cfg:
+    snap = _fetch_snapshot()
+    hit  = snap.index("Work_Orders").get(wo_id)
+    if not hit:
+        return
+    n, r = hit
+    milestones = json.loads(r["milestones_json"])
+    milestones[milestone_idx]["status"] = new_status
+    _sheet_update("Work_Orders", f"F{n}", [[json.dumps(milestones)]], snap)
+
+def _smtp_config():
+    cfg = dict(st.secrets.get("smtp", {}))
+    if not cfg:
         raise RuntimeError("SMTP not configured. Add [smtp] block to Streamlit secrets.")
+    return cfg
 
-    host = smtp_cfg["host"]
-    port = int(smtp_cfg.get("port", 587))
-    user = smtp_cfg["user"]
-    password = smtp_cfg["password"]
+def build_email(smtp_cfg, to_email, cc_emails, subject, body, attachments=()):
+    """(from address, recipients, message text); attachments are (filename, PDF bytes)."""
     from_name = smtp_cfg.get("from_name", "MIRU GRC")
-    from_addr = smtp_cfg.get("from_addr", user)
+    from_addr = smtp_cfg.get("from_addr", smtp_cfg["user"])
 
     msg = MIMEMultipart()
     msg["From"] = f"{from_name} <{from_addr}>"
@@ -583,151 +1716,385 @@ def send_invoice_email(to_email, cc_emails, subject, body, pdf_bytes, pdf_filena
 
     msg.attach(MIMEText(body, "plain"))
 
-    if pdf_bytes:
+    for filename, pdf_bytes in attachments:
         part = MIMEApplication(pdf_bytes, _subtype="pdf")
-        part.add_header("Content-Disposition", "attachment", filename=pdf_filename)
+        part.add_header("Content-Disposition", "attachment", filename=filename)
         msg.attach(part)
 
-    recipients = [to_email] + list(cc_emails or [])
-    with smtplib.SMTP(host, port, timeout=30) as s:
-        s.ehlo()
+    return from_addr, [to_email] + list(cc_emails or []), msg.as_string()
+
+def build_invoice_email(to_email, cc_emails, subject, body, pdf_bytes, pdf_filename):
+    """(from address, recipients, message text) of an approved-invoice email."""
+    return build_email(_smtp_config(), to_email, cc_emails, subject, body,
+                       [(pdf_filename, pdf_bytes)] if pdf_bytes else [])
+
+def _smtp_connect(smtp_cfg):
+    """An SMTP session, upgraded with STARTTLS and logged in unless the config
+    says starttls = false / has no password (a local stand-in server)."""
+    s = smtplib.SMTP(smtp_cfg["host"], int(smtp_cfg.get("port", 587)), timeout=30)
+    s.ehlo()
+    if smtp_cfg.get("starttls", True):
         s.starttls()
         s.ehlo()
-        s.login(user, password)
-        s.sendmail(from_addr, recipients, msg.as_string())
-    return True
+    if smtp_cfg.get("password"):
+        s.login(smtp_cfg["user"], smtp_cfg["password"])
+    return s
+
+def _smtp_send(smtp, smtp_cfg, from_addr, recipients, message):
+    """Send on an open session (or None), reconnecting once if the server
+    dropped it. Returns the session to reuse."""
+    if smtp is not None:
+        try:
+            smtp.sendmail(from_addr, recipients, message)
+            return smtp
+        except smtplib.SMTPServerDisconnected:
+            pass
+    smtp = _smtp_connect(smtp_cfg)
+    smtp.sendmail(from_addr, recipients, message)
+    return smtp
+
+# ── Email outbox ───────────────────────────────────────────────────────────────
+#
+# Emails are written to a SQLite outbox and sent by a background worker, so a
+# page never waits on SMTP and an outage only delays delivery. The worker keeps
+# one authenticated connection for as long as it has mail to send, and gives a
+# failed message a later next_at (1, 2, 4 … 30 min) until max_attempts.
+# Configure with an optional [outbox] block: path, max_attempts, idle_seconds.
+OUTBOX_DEFAULTS = {"path": "outbox.sqlite3", "max_attempts": 8, "idle_seconds": 60}
+
+def _permanent_smtp_error(e):
+    """Recipient refusals and other 5xx replies fail the message at once; a
+    refused login is treated as an outage, since fixing secrets cures it."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return True
+    return (isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+            and not isinstance(e, smtplib.SMTPAuthenticationError))
+
+class Outbox:
+    """Durable email queue: one row per message with its delivery status —
+    queued, sent or failed — and attempts, last error and next retry time."""
+
+    def __init__(self, path, smtp_cfg, max_attempts=8, idle_seconds=60):
+        self.conn         = sqlite3.connect(path, check_same_thread=False)
+        self.lock         = threading.Lock()
+        self.smtp_cfg     = smtp_cfg
+        self.max_attempts = int(max_attempts)
+        self.idle         = float(idle_seconds)
+        self._wake        = threading.Event()
+        self._hold        = 0.0   # after a transient failure, nothing is sent before this
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                              "doc_id TEXT, from_addr TEXT, recipients TEXT, message TEXT, status TEXT, "
+                              "attempts INTEGER DEFAULT 0, next_at REAL, last_error TEXT, "
+                              "created_at TEXT, sent_at TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_outbox_doc ON outbox (doc_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox (status, next_at)")
+        threading.Thread(target=self._run, name="outbox", daemon=True).start()
+
+    def enqueue(self, doc_id, from_addr, recipients, message):
+        with self.lock, self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO outbox (doc_id, from_addr, recipients, message, status, next_at, created_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (doc_id, from_addr, json.dumps(recipients), message, time.time(), datetime.now().isoformat()))
+        self._wake.set()
+        return cur.lastrowid
+
+    def status(self, doc_id):
+        """The latest message for doc_id as a dict, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT id, recipients, status, attempts, next_at, last_error, created_at, sent_at "
+                                    "FROM outbox WHERE doc_id = ? ORDER BY id DESC LIMIT 1", (doc_id,)).fetchone()
+        if not row:
+            return None
+        keys = ("id", "recipients", "status", "attempts", "next_at", "last_error", "created_at", "sent_at")
+        return {**dict(zip(keys, row)), "recipients": json.loads(row[1])}
+
+    def retry(self, msg_id):
+        """Send a message again now, from the top of its retry schedule."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE outbox SET status = 'queued', attempts = 0, next_at = ? WHERE id = ?",
+                              (time.time(), msg_id))
+        self._hold = 0.0
+        self._wake.set()
+
+    def _due(self):
+        with self.lock:
+            return self.conn.execute("SELECT id, from_addr, recipients, message, attempts FROM outbox "
+                                     "WHERE status = 'queued' AND next_at <= ? ORDER BY id LIMIT 20",
+                                     (time.time(),)).fetchall()
+
+    def _next_at(self):
+        with self.lock:
+            return self.conn.execute("SELECT MIN(next_at) FROM outbox WHERE status = 'queued'").fetchone()[0]
+
+    def _mark(self, msg_id, **cols):
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE outbox SET {', '.join(f'{k} = ?' for k in cols)} WHERE id = ?",
+                              [*cols.values(), msg_id])
+
+    def _run(self):
+        smtp, used_at = None, 0.0
+        while True:
+            for msg_id, from_addr, recipients, message, attempts in (self._due() if time.time() >= self._hold else []):
+                try:
+                    smtp    = _smtp_send(smtp, self.smtp_cfg, from_addr, json.loads(recipients), message)
+                    used_at = time.time()
+                    self._mark(msg_id, status="sent", attempts=attempts + 1, last_error="",
+                               sent_at=datetime.now().isoformat())
+                except Exception as e:
+                    smtp      = None   # state unknown after an error — start the next send afresh
+                    attempts += 1
+                    dead      = attempts >= self.max_attempts or _permanent_smtp_error(e)
+                    next_at   = time.time() + min(1800.0, 60 * 2 ** (attempts - 1)) * (0.5 + random.random())
+                    self._mark(msg_id, status="failed" if dead else "queued", attempts=attempts,
+                               last_error=str(e), next_at=next_at)
+                    if not dead:
+                        self._hold = next_at   # likely an outage — hold the whole queue until this retry
+                        break
+            if smtp is not None and time.time() - used_at >= self.idle:
+                try:
+                    smtp.quit()
+                except Exception:
+                    pass
+                smtp = None
+            nxt  = self._next_at()
+            wake = max(self._hold, nxt) if nxt is not None else time.time() + self.idle
+            if smtp is not None:
+                wake = min(wake, used_at + self.idle)
+            self._wake.wait(min(self.idle, max(0.0, wake - time.time())))
+            self._wake.clear()
+
+@st.cache_resource
+def _outbox():
+    cfg = {**OUTBOX_DEFAULTS, **dict(st.secrets.get("outbox", {}))}
+    return Outbox(cfg["path"], dict(st.secrets.get("smtp", {})), cfg["max_attempts"], cfg["idle_seconds"])
+
+def queue_invoice_email(doc_id, to_email, cc_emails, subject, body, pdf_bytes, pdf_filename):
+    """Put an approved-invoice email in the outbox; returns at once."""
+    return _outbox().enqueue(doc_id, *build_invoice_email(to_email, cc_emails, subject, body, pdf_bytes, pdf_filename))
+
+def email_status(doc_id):
+    return _outbox().status(doc_id)
+
+# ── Statements ─────────────────────────────────────────────────────────────────
+#
+# Month-end mail: every approved document of a period, one message per client
+# with all of its PDFs, sent to the client's email over a single SMTP session.
+# Optional [statements] block: per_minute (throttle, 0 = none), dry_run_host/dry_run_port
+# — a local stand-in such as `python -m aiosmtpd -n -l localhost:1025`.
+STATEMENT_DEFAULTS = {"per_minute": 20, "dry_run_host": "localhost", "dry_run_port": 1025}
+
+def statement_batches(start, end):
+    """[(client record, [approved docs dated start..end])] per client with
+    documents, oldest first; the client record is {"name": …} if unknown."""
+    clients = {c["name"]: c for c in get_clients()}
+    by_client = {}
+    for d in reversed(find_documents("All", "Approved")):
+        if start.isoformat() <= str(d.get("doc_date", ""))[:10] <= end.isoformat():
+            by_client.setdefault(d["client_name"], []).append(d)
+    return [(clients.get(name, {"name": name}), docs) for name, docs in sorted(by_client.items())]
+
+def _statement_message(smtp_cfg, client, docs, pdfs, start, end):
+    period = f"{start:%d %b %Y} – {end:%d %b %Y}"
+    lines  = "\n".join(f"  • {d['doc_type']} {d.get('doc_code') or d['doc_id']} dated {d['doc_date']}"
+                       f" — {d.get('project_name','')}" for d in docs)
+    body = (
+        f"Dear {client.get('contact_name') or client['name']},\n\n"
+        f"Please find attached the approved documents for {period}:\n\n{lines}\n\n"
+        f"Regards,\nMIRU GRC"
+    )
+    return build_email(smtp_cfg, str(client["email"]).strip(), [], f"Statement of documents — {period}", body,
+                       [(f"{d['doc_id']}_{d['client_name'].replace(' ','_')}.pdf", pdfs[d["doc_id"]]) for d in docs])
+
+def send_statements(batches, start, end, dry_run=False, workers=4, on_progress=None):
+    """Email each (client, docs) batch. PDFs come from the artifact store,
+    rendered there first where missing, on a bounded pool while earlier
+    messages send. Messages go out over one SMTP session, at most per_minute
+    a minute (0 = unthrottled); dry_run sends them to the local stand-in server instead.
+    Returns {client name: "sent" or the error}."""
+    cfg      = {**STATEMENT_DEFAULTS, **dict(st.secrets.get("statements", {}))}
+    smtp_cfg = dict(st.secrets.get("smtp", {}))
+    if dry_run:
+        smtp_cfg = {"user": smtp_cfg.get("user", "statements@localhost"), "from_name": smtp_cfg.get("from_name", "MIRU GRC"),
+                    "host": cfg["dry_run_host"], "port": cfg["dry_run_port"], "starttls": False}
+    elif not smtp_cfg:
+        raise RuntimeError("SMTP not configured. Add [smtp] block to Streamlit secrets.")
+    per_minute = float(cfg["per_minute"])
+    gap = 60.0 / per_minute if per_minute > 0 else 0.0
+
+    results, smtp, last = {}, None, 0.0
+    with _ctx_pool(workers, "statements") as pool:
+        futs = {d["doc_id"]: pool.submit(final_pdf, "Documents", d["doc_id"])
+                for client, docs in batches if str(client.get("email", "") or "").strip() for d in docs}
+        for done, (client, docs) in enumerate(batches, 1):
+            try:
+                if not str(client.get("email", "") or "").strip():
+                    raise ValueError("no email in Clients")
+                message = _statement_message(smtp_cfg, client, docs,
+                                             {d["doc_id"]: futs[d["doc_id"]].result() for d in docs}, start, end)
+                time.sleep(max(0.0, last + gap - time.time()))
+                smtp = _smtp_send(smtp, smtp_cfg, *message)
+                last = time.time()
+                results[client["name"]] = "sent"
+            except Exception as e:
+                if isinstance(e, (smtplib.SMTPException, OSError)):
+                    smtp = None
+                results[client["name"]] = str(e)
+            if on_progress:
+                on_progress(done, len(batches), client["name"])
+    if smtp is not None:
+        try:
+            smtp.quit()
+        except Exception:
+            pass
+    return results
 
 
 def approve_doc(doc_id, manager_name, signature_b64):
-    ws = get_sheet().worksheet("Documents")
-    for i, r in enumerate(_fetch_documents()):
-        if r["doc_id"] == doc_id:
-            n = i + 2
-            ws.update(f"C{n}", [["Approved"]])
-            ws.update(f"O{n}", [[manager_name]])
-            ws.update(f"P{n}", [[datetime.now().isoformat()]])
-            if signature_b64:
-                ws.update(f"Q{n}", [[signature_b64]])
-            _bust()
-            return True
-    return False
+    snap = _fetch_snapshot()
+    hit  = snap.index("Documents").get(doc_id)
+    if not hit:
+        return False
+    n, _ = hit
+    updates = [
+        (_a1(DOC_HEADERS, "status", n),      [["Approved"]]),
+        (_a1(DOC_HEADERS, "approved_by", n), [[manager_name]]),
+        (_a1(DOC_HEADERS, "approved_at", n), [[datetime.now().isoformat()]]),
+        (_a1(DOC_HEADERS, "pdf_sha256", n),  [[""]]),   # a previous approval's PDF — final_pdf waits for this one
+    ]
+    if signature_b64:
+        updates.append((_a1(DOC_HEADERS, "signature_b64", n), [[signature_b64]]))
+    _sheet_batch_update("Documents", updates, snap)
+    persist_pdf("Documents", doc_id)
+    return True
+
+def repair_approvals(snap=None):
+    """Shift approvals written one column to the left back into place.
+
+    Approvals made before the columns were taken from DOC_HEADERS put the
+    manager in approval_token, the time in approved_by and the signature in
+    approved_at. Such rows get their three values moved one column right, a
+    fresh approval_token and their stored PDF dropped, so final_pdf renders it
+    again. Returns how many rows were repaired."""
+    snap    = snap or _fetch_snapshot()
+    updates = []
+    for n, rec in snap.index("Documents").values():
+        token = str(rec.get("approval_token", "") or "")
+        if (not token or token == make_token(rec["doc_id"]) or _iso_time(rec.get("approved_at"))
+                or not _iso_time(rec.get("approved_by"))):
+            continue
+        updates += [(_a1(DOC_HEADERS, "approval_token", n),
+                     [[make_token(rec["doc_id"]), token, str(rec["approved_by"]), str(rec.get("approved_at", "") or "")]]),
+                    (_a1(DOC_HEADERS, "pdf_sha256", n), [[""]])]   # its stored PDF was built from the shifted values
+    if updates:
+        _sheet_batch_update("Documents", updates, snap)
+    return len(updates) // 2
 
 def update_status(doc_id, status):
-    ws = get_sheet().worksheet("Documents")
-    for i, r in enumerate(_fetch_documents()):
-        if r["doc_id"] == doc_id:
-            ws.update(f"C{i+2}", [[status]])
-            _bust()
-            return
+    snap = _fetch_snapshot()
+    hit  = snap.index("Documents").get(doc_id)
+    if not hit:
+        return
+    n = hit[0]
+    updates = [(_a1(DOC_HEADERS, "status", n), [[status]])]
+    if status != "Approved":
+        updates.append((_a1(DOC_HEADERS, "pdf_sha256", n), [[""]]))
+    _sheet_batch_update("Documents", updates, snap)
+    if status == "Pending Approval":
+        prerender(doc_id)
 
 # ── PDF builder ────────────────────────────────────────────────────────────────
-
-def build_html_tax_invoice(data, signature_b64=None):
-    """GST Tax Invoice — matches the standard Indian format."""
-    items = data.get("items") or json.loads(data.get("items_json", "[]"))
-
-    # Client GSTIN lookup
-    try:
-        client_data = next((c for c in get_clients() if c["name"] == data.get("client_name", "")), {})
-        client_gstin = client_data.get("gst_number", "")
-    except Exception:
-        client_gstin = ""
-
-    seller_code = "08"
-    client_code = client_gstin[:2] if len(client_gstin) >= 2 else ""
-    client_state = STATE_NAMES.get(client_code, "")
-    is_igst = client_code and client_code != seller_code
-
-    # Build item rows + compute totals in one pass
-    rows_html = ""
-    sl = 1
-    subtotal = 0.0
-    total_qty = 0.0
-    total_unit = "Sqft"
-    hsn_main = "68109990"
-
-    for it in items:
-        qty   = float(it.get("qty", 0))
-        total_qty += qty
-        total_unit = it.get("unit", "Sqft")
-        hsn   = it.get("hsn", "") or "68109990"
-        hsn_main = hsn
-        desc  = it.get("desc", "")
-        app   = float(it.get("area_per_piece", 0))
-        pcs   = float(it.get("pieces", 0))
-        stype = it.get("sale_type", "Supply")
-
-        sub = f"<br><small style='font-size:8.5pt;'>Area of One Piece {app} {total_unit} ({int(pcs)} Pcs)</small>" if app > 0 and pcs > 0 else ""
-
-        if stype == "Supply & Installation" and (it.get("supply_rate") or it.get("install_rate")):
-            sr = float(it.get("supply_rate") or 0)
-            ir = float(it.get("install_rate") or 0)
-            if sr:
-                subtotal += qty * sr
-                rows_html += f"<tr><td align='right'>{sl}</td><td><b>Supply of {desc}</b>{sub}</td><td align='center'>{hsn}</td><td align='right'>{format_inr(qty)} {total_unit}</td><td align='right'>{format_inr(sr)}</td><td align='center'>{total_unit}</td><td align='right'>{format_inr(qty*sr)}</td></tr>"
-                sl += 1
-            if ir:
-                subtotal += qty * ir
-                rows_html += f"<tr><td align='right'>{sl}</td><td><b>Installation of {desc}</b></td><td align='center'>{hsn}</td><td align='right'>{format_inr(qty)} {total_unit}</td><td align='right'>{format_inr(ir)}</td><td align='center'>{total_unit}</td><td align='right'>{format_inr(qty*ir)}</td></tr>"
-                sl += 1
-        else:
-            rate = float(it.get("rate", 0))
-            subtotal += qty * rate
-            rows_html += f"<tr><td align='right'>{sl}</td><td><b>{desc}</b>{sub}</td><td align='center'>{hsn}</td><td align='right'>{format_inr(qty)} {total_unit}</td><td align='right'>{format_inr(rate)}</td><td align='center'>{total_unit}</td><td align='right'>{format_inr(qty*rate)}</td></tr>"
-            sl += 1
-
-    transport_amount = float(data.get("transport_amount", 0) or 0)
-    tax_amount  = subtotal * 0.18
-    grand_pre   = subtotal + tax_amount + transport_amount
-    grand       = round(grand_pre)
-    round_off   = grand - grand_pre
-    round_str   = f"{round_off:+.2f}" if abs(round_off) > 0.001 else "0.00"
-
-    # Tax rows inside items table
-    if is_igst:
-        tax_rows_html = f"<tr><td colspan='5' style='font-style:italic'>Out Put IGST @ 18%</td><td align='center'>18 %</td><td align='right'>{format_inr(tax_amount)}</td></tr>"
-        tax_table_html = f"""<table style='margin-top:4px;'>
+#
+# Every layout is parsed once, at import, into a string.Template, and a build
+# substitutes a plain dict of strings into it. Item rows come from a row layout
+# and are joined once, not appended to a growing string. Nothing here reads
+# the clock; the quotation footer prints the generated_at it is given.
+
+class _Layout:
+    """Markup with ${name} fields, parsed once into a string.Template; render
+    fills it from the context dict and raises KeyError on a missing field."""
+
+    def __init__(self, text):
+        self.template = Template(text)
+        self.render   = self.template.substitute
+
+    def render_rows(self, rows):
+        return "".join(map(self.render, rows))
+
+WATERMARK_HTML   = "<div class='watermark'>NOT APPROVED</div>"
+SIG_IMG_LAYOUT   = _Layout("<img src='data:image/png;base64,${sig}' style='height:50px;display:block;margin:8px auto;'>")
+NO_SIG_HTML      = "<div style='height:60px;'></div>"
+
+TI_ROW_LAYOUT    = _Layout("<tr><td align='right'>${sl}</td><td><b>${desc}</b>${sub}</td><td align='center'>${hsn}</td>"
+                           "<td align='right'>${qty} ${unit}</td><td align='right'>${rate}</td>"
+                           "<td align='center'>${unit}</td><td align='right'>${amount}</td></tr>")
+TI_TAX_ROW_LAYOUT = _Layout("<tr><td colspan='5' style='font-style:italic'>Out Put ${tax} @ ${pct}%</td>"
+                            "<td align='center'>${pct} %</td><td align='right'>${amount}</td></tr>")
+TI_IGST_LAYOUT   = _Layout("""<table style='margin-top:4px;'>
           <thead><tr><th>HSN/SAC</th><th>Taxable Value</th><th>Rate</th><th>IGST Amount</th><th>Tax Amount</th></tr></thead>
           <tbody>
-            <tr><td align='center'>{hsn_main}</td><td align='right'>₹{format_inr(subtotal)}</td><td align='center'>18%</td><td align='right'>₹{format_inr(tax_amount)}</td><td align='right'>₹{format_inr(tax_amount)}</td></tr>
-            <tr><td><b>Total</b></td><td align='right'><b>₹{format_inr(subtotal)}</b></td><td></td><td align='right'><b>₹{format_inr(tax_amount)}</b></td><td align='right'><b>₹{format_inr(tax_amount)}</b></td></tr>
-          </tbody></table>"""
-    else:
-        cgst = subtotal * 0.09
-        tax_rows_html = (f"<tr><td colspan='5' style='font-style:italic'>Out Put CGST @ 9%</td><td align='center'>9 %</td><td align='right'>{format_inr(cgst)}</td></tr>"
-                       + f"<tr><td colspan='5' style='font-style:italic'>Out Put SGST @ 9%</td><td align='center'>9 %</td><td align='right'>{format_inr(cgst)}</td></tr>")
-        tax_table_html = f"""<table style='margin-top:4px;'>
+            <tr><td align='center'>${hsn}</td><td align='right'>₹${taxable}</td><td align='center'>18%</td><td align='right'>₹${tax}</td><td align='right'>₹${tax}</td></tr>
+            <tr><td><b>Total</b></td><td align='right'><b>₹${taxable}</b></td><td></td><td align='right'><b>₹${tax}</b></td><td align='right'><b>₹${tax}</b></td></tr>
+          </tbody></table>""")
+TI_CGST_LAYOUT   = _Layout("""<table style='margin-top:4px;'>
           <thead><tr><th>HSN/SAC</th><th>Taxable Value</th><th>CGST 9%</th><th>CGST Amt</th><th>SGST 9%</th><th>SGST Amt</th><th>Tax Amount</th></tr></thead>
           <tbody>
-            <tr><td align='center'>{hsn_main}</td><td align='right'>₹{format_inr(subtotal)}</td><td align='center'>9%</td><td align='right'>₹{format_inr(cgst)}</td><td align='center'>9%</td><td align='right'>₹{format_inr(cgst)}</td><td align='right'>₹{format_inr(tax_amount)}</td></tr>
-            <tr><td><b>Total</b></td><td align='right'><b>₹{format_inr(subtotal)}</b></td><td></td><td align='right'><b>₹{format_inr(cgst)}</b></td><td></td><td align='right'><b>₹{format_inr(cgst)}</b></td><td align='right'><b>₹{format_inr(tax_amount)}</b></td></tr>
-          </tbody></table>"""
-
-    sig_img = f"<img src='data:image/png;base64,{signature_b64}' style='height:50px;display:block;margin:8px auto;'>" if signature_b64 else "<div style='height:60px;'></div>"
-    vehicle_no  = data.get("vehicle_no", "") or ""
-    transporter = data.get("transporter_name", "") or ""
-    delivery_dest = (data.get("delivery_address", "") or "").split("\n")[0]
-    delivery_addr = (data.get("delivery_address", "") or "").replace("\n", "<br>")
-    billing_addr  = (data.get("billing_address",  "") or "").replace("\n", "<br>")
-    gstin_line = f"GSTIN/UIN: {client_gstin}<br>" if client_gstin else ""
-    state_line = f"State Name: {client_state}, Code: {client_code}" if client_state else ""
-
-    return f"""<!DOCTYPE html>
+            <tr><td align='center'>${hsn}</td><td align='right'>₹${taxable}</td><td align='center'>9%</td><td align='right'>₹${half}</td><td align='center'>9%</td><td align='right'>₹${half}</td><td align='right'>₹${tax}</td></tr>
+            <tr><td><b>Total</b></td><td align='right'><b>₹${taxable}</b></td><td></td><td align='right'><b>₹${half}</b></td><td></td><td align='right'><b>₹${half}</b></td><td align='right'><b>₹${tax}</b></td></tr>
+          </tbody></table>""")
+
+CHALLAN_ROW_LAYOUT = _Layout("<tr><td align='right'>${sl}</td><td><b>${desc}</b>${sub}</td><td align='center'>${hsn}</td>"
+                             "<td align='right'>${qty}</td><td align='center'>${unit}</td><td>${remarks}</td></tr>")
+
+QUOTE_ROW_LAYOUT = _Layout("<tr><td>${type}</td><td>${hsn}</td><td>${desc}</td>"
+                           "<td>${qty}</td><td>${unit}</td><td>₹${rate}</td>"
+                           "<td>₹${amount}</td></tr>")
+QUOTE_VALIDITY_LAYOUT = _Layout("<p style='font-size:11px;margin:2px 0'><b>Valid Until:</b> ${validity_date}</p>")
+QUOTE_EWB_LAYOUT = _Layout("""
+        <div style='background:#f0f7ff;border:1px solid #c0d8f0;border-radius:4px;padding:8px 12px;margin-bottom:16px;font-size:11px;'>
+          <b>🚛 E-Way Bill Details</b>&nbsp;&nbsp;
+          Vehicle: <b>${vehicle_no}</b>&nbsp;&nbsp;|&nbsp;&nbsp;
+          Transporter: <b>${transporter_name}</b>&nbsp;&nbsp;|&nbsp;&nbsp;
+          Distance: <b>${distance_km} km</b>&nbsp;&nbsp;|&nbsp;&nbsp;
+          Mode: <b>${transport_mode}</b>
+        </div>""")
+QUOTE_SIG_LAYOUT = _Layout("""
+        <div style='margin-top:50px;text-align:right;'>
+            <img src='data:image/png;base64,${sig}' style='height:60px;'><br>
+            <small style='font-size:10px;'>Authorised Signatory: ${approved_by}</small>
+        </div>""")
+QUOTE_TERM_LAYOUT = _Layout("<p style='margin:3px 0'>${n}. ${term}</p>")
+QUOTE_BANK_LAYOUT = _Layout("""
+<table style='width:60%;border-collapse:collapse;font-size:11px;'>
+  <tr><td colspan='2' style='font-weight:700;padding:4px 0;border-bottom:1px solid #ccc;'>BANK DETAILS</td></tr>
+  <tr><td style='padding:2px 8px 2px 0;color:#555;width:40%'>Bank Name</td><td><b>${bank_name}</b></td></tr>
+  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Account Name</td><td><b>${account_name}</b></td></tr>
+  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Account Number</td><td><b>${account_no}</b></td></tr>
+  <tr><td style='padding:2px 8px 2px 0;color:#555;'>IFSC Code</td><td><b>${ifsc}</b></td></tr>
+  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Branch</td><td>${branch}</td></tr>
+  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Account Type</td><td>${account_type}</td></tr>
+</table>""")
+
+TAX_INVOICE_HTML = """<!DOCTYPE html>
 <html><head><meta charset='UTF-8'>
 <style>
-@page {{margin:8mm 10mm;}}
-body{{font-family:Arial,sans-serif;font-size:10pt;color:#000;margin:0;}}
-.page{{border:1px solid #000;padding:6px;}}
-.title{{text-align:center;font-size:15pt;font-weight:bold;border-bottom:2px solid #000;padding-bottom:4px;margin-bottom:0;}}
-table{{border-collapse:collapse;width:100%;}}
-td,th{{border:1px solid #000;padding:3px 5px;font-size:9.5pt;vertical-align:top;}}
-th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
-.grid td{{border:none;border-bottom:1px solid #bbb;border-right:1px solid #bbb;padding:2px 4px;font-size:8.5pt;}}
-.grid td:last-child{{border-right:none;}}
-.grid tr:last-child td{{border-bottom:none;}}
+@page {margin:8mm 10mm;}
+body{font-family:Arial,sans-serif;font-size:10pt;color:#000;margin:0;}
+.page{border:1px solid #000;padding:6px;}
+.title{text-align:center;font-size:15pt;font-weight:bold;border-bottom:2px solid #000;padding-bottom:4px;margin-bottom:0;}
+table{border-collapse:collapse;width:100%;}
+td,th{border:1px solid #000;padding:3px 5px;font-size:9.5pt;vertical-align:top;}
+th{background:#f0f0f0;font-weight:bold;text-align:center;}
+.grid td{border:none;border-bottom:1px solid #bbb;border-right:1px solid #bbb;padding:2px 4px;font-size:8.5pt;}
+.grid td:last-child{border-right:none;}
+.grid tr:last-child td{border-bottom:none;}
+.watermark{position:fixed;top:50%;left:50%;transform:translate(-50%,-50%) rotate(-45deg);
+  font-size:90px;font-weight:900;color:rgba(255,0,0,0.12);white-space:nowrap;
+  pointer-events:none;z-index:9999;letter-spacing:8px;}
 </style>
-</head><body><div class='page'>
-<div class='title'>Tax Invoice</div>
+</head><body><div class='page'>${watermark}
+<div class='title'>Tax Invoice${page_label}</div>
 
 <table>
   <tr>
@@ -740,14 +2107,14 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
     </td>
     <td style='width:56%;padding:0;'>
       <table class='grid'>
-        <tr><td style='width:34%'>Invoice No.</td><td style='width:28%'><b>{data['doc_id']}</b></td><td style='width:18%'>Dated</td><td><b>{data['doc_date']}</b></td></tr>
-        <tr><td>Reference</td><td>{data.get('project_name','')}</td><td>Other References</td><td></td></tr>
+        <tr><td style='width:34%'>Invoice No.</td><td style='width:28%'><b>${doc_id}</b></td><td style='width:18%'>Dated</td><td><b>${doc_date}</b></td></tr>
+        <tr><td>Reference</td><td>${project_name}</td><td>Other References</td><td></td></tr>
         <tr><td>Delivery Note</td><td></td><td>Mode/Terms of Payment</td><td></td></tr>
         <tr><td>Buyer's Order No.</td><td></td><td>Dated</td><td></td></tr>
         <tr><td>Dispatch Doc No.</td><td></td><td>Delivery Note Date</td><td></td></tr>
-        <tr><td>Dispatched through</td><td>{transporter}</td><td>Destination</td><td>{delivery_dest}</td></tr>
-        <tr><td>Motor Vehicle No.</td><td>{vehicle_no}</td><td>Terms of Delivery</td><td></td></tr>
-        <tr><td>EWB No. dt. {data['doc_date']}</td><td></td><td>Mode of Transport</td><td>{data.get('transport_mode','Road')}</td></tr>
+        <tr><td>Dispatched through</td><td>${transporter}</td><td>Destination</td><td>${delivery_dest}</td></tr>
+        <tr><td>Motor Vehicle No.</td><td>${vehicle_no}</td><td>Terms of Delivery</td><td></td></tr>
+        <tr><td>EWB No. dt. ${doc_date}</td><td></td><td>Mode of Transport</td><td>${transport_mode}</td></tr>
       </table>
     </td>
   </tr>
@@ -757,13 +2124,13 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
   <tr>
     <td style='width:50%;'>
       <b>Consignee (Ship to)</b><br>
-      {data['client_name']}<br>{delivery_addr}<br>
-      {gstin_line}{state_line}
+      ${client_name}<br>${delivery_addr}<br>
+      ${gstin_line}${state_line}
     </td>
     <td style='width:50%;'>
       <b>Buyer (Bill to)</b><br>
-      {data['client_name']}<br>{billing_addr}<br>
-      {gstin_line}{state_line}
+      ${client_name}<br>${billing_addr}<br>
+      ${gstin_line}${state_line}
     </td>
   </tr>
 </table>
@@ -772,19 +2139,19 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
   <thead>
     <tr><th style='width:4%'>Sl No.</th><th style='width:38%'>Description of Goods</th><th style='width:10%'>HSN/SAC</th><th style='width:12%'>Quantity</th><th style='width:12%'>Rate</th><th style='width:6%'>per</th><th style='width:18%'>Amount</th></tr>
   </thead>
-  <tbody>{rows_html}</tbody>
-  {tax_rows_html}
-  <tr><td colspan='6'><b>Round Off</b></td><td align='right'>{round_str}</td></tr>
-  <tr><td colspan='3'><b>Total</b></td><td align='right'><b>{format_inr(total_qty)} {total_unit}</b></td><td></td><td></td><td align='right'><b>₹ {format_inr(grand)}</b></td></tr>
+  <tbody>${rows}</tbody>
+  ${tax_rows}
+  <tr><td colspan='6'><b>Round Off</b></td><td align='right'>${round_off}</td></tr>
+  <tr><td colspan='3'><b>Total</b></td><td align='right'><b>${total_qty} ${total_unit}</b></td><td></td><td></td><td align='right'><b>₹ ${grand}</b></td></tr>
 </table>
 
 <table>
   <tr><td style='border-bottom:none;'><b>Amount Chargeable (in words)</b></td><td align='right' style='border-bottom:none;'>E. &amp; O.E</td></tr>
-  <tr><td colspan='2'><b>INR {amount_in_words(grand)}</b></td></tr>
+  <tr><td colspan='2'><b>INR ${grand_words}</b></td></tr>
 </table>
 
-{tax_table_html}
-<div style='padding:3px 0;font-size:9pt;'><b>Tax Amount (in words):</b> INR {amount_in_words(int(tax_amount))}</div>
+${tax_table}
+<div style='padding:3px 0;font-size:9pt;'><b>Tax Amount (in words):</b> INR ${tax_words}</div>
 
 <table style='margin-top:8px;'>
   <tr>
@@ -794,7 +2161,7 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
     </td>
     <td style='width:40%;text-align:center;'>
       for MIRU GRC C/O MIXD STUDIO BY RMT<br>
-      {sig_img}
+      ${sig_img}
       <b>Authorised Signatory</b>
     </td>
   </tr>
@@ -803,62 +2170,25 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
 <div style='text-align:center;font-size:9pt;margin-top:6px;'>This is a Computer Generated Invoice</div>
 </div></body></html>"""
 
-def build_html_challan(data, signature_b64=None):
-    """Delivery Challan — dispatch details only, no rates or amounts."""
-    items = data.get("items") or json.loads(data.get("items_json", "[]"))
-
-    vehicle_no  = data.get("vehicle_no", "") or ""
-    transporter = data.get("transporter_name", "") or ""
-    transport_mode = data.get("transport_mode", "Road") or "Road"
-    purpose     = data.get("notes", "Supply") or "Supply"
-    delivery_addr = (data.get("delivery_address", "") or "").replace("\n", "<br>")
-    billing_addr  = (data.get("billing_address",  "") or "").replace("\n", "<br>")
-
-    # Try client GSTIN lookup
-    try:
-        client_data  = next((c for c in get_clients() if c["name"] == data.get("client_name", "")), {})
-        client_gstin = client_data.get("gst_number", "")
-    except Exception:
-        client_gstin = ""
-    client_code  = client_gstin[:2] if len(client_gstin) >= 2 else ""
-    client_state = STATE_NAMES.get(client_code, "")
-    gstin_line   = f"GSTIN/UIN: {client_gstin}<br>" if client_gstin else ""
-    state_line   = f"State Name: {client_state}, Code: {client_code}" if client_state else ""
-
-    # Item rows (no rates)
-    rows_html  = ""
-    total_qty  = {}   # unit → qty
-    for sl, it in enumerate(items, 1):
-        qty  = float(it.get("qty", 0))
-        unit = it.get("unit", "Sqft")
-        hsn  = it.get("hsn", "") or "68109990"
-        desc = it.get("desc", "")
-        app  = float(it.get("area_per_piece", 0))
-        pcs  = float(it.get("pieces", 0))
-        rmk  = it.get("remarks", "")
-        sub  = f"<br><small style='font-size:8.5pt;'>Area of One Piece: {app} {unit} × {int(pcs)} Pcs</small>" if app > 0 and pcs > 0 else ""
-        rows_html += f"<tr><td align='right'>{sl}</td><td><b>{desc}</b>{sub}</td><td align='center'>{hsn}</td><td align='right'>{format_inr(qty)}</td><td align='center'>{unit}</td><td>{rmk}</td></tr>"
-        total_qty[unit] = total_qty.get(unit, 0) + qty
-
-    total_str = " | ".join(f"{format_inr(v)} {u}" for u, v in total_qty.items())
-    sig_img   = f"<img src='data:image/png;base64,{signature_b64}' style='height:50px;display:block;margin:8px auto;'>" if signature_b64 else "<div style='height:60px;'></div>"
-
-    return f"""<!DOCTYPE html>
+CHALLAN_HTML = """<!DOCTYPE html>
 <html><head><meta charset='UTF-8'>
 <style>
-@page {{margin:8mm 10mm;}}
-body{{font-family:Arial,sans-serif;font-size:10pt;color:#000;margin:0;}}
-.page{{border:1px solid #000;padding:6px;}}
-.title{{text-align:center;font-size:15pt;font-weight:bold;border-bottom:2px solid #000;padding-bottom:4px;}}
-table{{border-collapse:collapse;width:100%;}}
-td,th{{border:1px solid #000;padding:3px 5px;font-size:9.5pt;vertical-align:top;}}
-th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
-.grid td{{border:none;border-bottom:1px solid #bbb;border-right:1px solid #bbb;padding:2px 4px;font-size:8.5pt;}}
-.grid td:last-child{{border-right:none;}}
-.grid tr:last-child td{{border-bottom:none;}}
+@page {margin:8mm 10mm;}
+body{font-family:Arial,sans-serif;font-size:10pt;color:#000;margin:0;}
+.page{border:1px solid #000;padding:6px;}
+.title{text-align:center;font-size:15pt;font-weight:bold;border-bottom:2px solid #000;padding-bottom:4px;}
+table{border-collapse:collapse;width:100%;}
+td,th{border:1px solid #000;padding:3px 5px;font-size:9.5pt;vertical-align:top;}
+th{background:#f0f0f0;font-weight:bold;text-align:center;}
+.grid td{border:none;border-bottom:1px solid #bbb;border-right:1px solid #bbb;padding:2px 4px;font-size:8.5pt;}
+.grid td:last-child{border-right:none;}
+.grid tr:last-child td{border-bottom:none;}
+.watermark{position:fixed;top:50%;left:50%;transform:translate(-50%,-50%) rotate(-45deg);
+  font-size:90px;font-weight:900;color:rgba(255,0,0,0.12);white-space:nowrap;
+  pointer-events:none;z-index:9999;letter-spacing:8px;}
 </style>
-</head><body><div class='page'>
-<div class='title'>Delivery Challan</div>
+</head><body><div class='page'>${watermark}
+<div class='title'>Delivery Challan${page_label}</div>
 
 <table>
   <tr>
@@ -871,10 +2201,10 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
     </td>
     <td style='width:56%;padding:0;'>
       <table class='grid'>
-        <tr><td style='width:36%'>Challan No.</td><td style='width:28%'><b>{data['doc_id']}</b></td><td style='width:18%'>Date</td><td><b>{data['doc_date']}</b></td></tr>
-        <tr><td>Purpose</td><td colspan='3'><b>{purpose}</b></td></tr>
-        <tr><td>Vehicle No.</td><td><b>{vehicle_no}</b></td><td>Mode</td><td>{transport_mode}</td></tr>
-        <tr><td>Transporter</td><td>{transporter}</td><td>Project</td><td>{data.get('project_name','')}</td></tr>
+        <tr><td style='width:36%'>Challan No.</td><td style='width:28%'><b>${doc_id}</b></td><td style='width:18%'>Date</td><td><b>${doc_date}</b></td></tr>
+        <tr><td>Purpose</td><td colspan='3'><b>${purpose}</b></td></tr>
+        <tr><td>Vehicle No.</td><td><b>${vehicle_no}</b></td><td>Mode</td><td>${transport_mode}</td></tr>
+        <tr><td>Transporter</td><td>${transporter}</td><td>Project</td><td>${project_name}</td></tr>
       </table>
     </td>
   </tr>
@@ -884,13 +2214,13 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
   <tr>
     <td style='width:50%;'>
       <b>Consignee (Ship to)</b><br>
-      {data['client_name']}<br>{delivery_addr}<br>
-      {gstin_line}{state_line}
+      ${client_name}<br>${delivery_addr}<br>
+      ${gstin_line}${state_line}
     </td>
     <td style='width:50%;'>
       <b>Buyer (Bill to)</b><br>
-      {data['client_name']}<br>{billing_addr}<br>
-      {gstin_line}{state_line}
+      ${client_name}<br>${billing_addr}<br>
+      ${gstin_line}${state_line}
     </td>
   </tr>
 </table>
@@ -899,12 +2229,12 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
   <thead>
     <tr><th style='width:4%'>Sl No.</th><th style='width:42%'>Description of Goods</th><th style='width:10%'>HSN/SAC</th><th style='width:12%'>Quantity</th><th style='width:8%'>Unit</th><th style='width:24%'>Remarks</th></tr>
   </thead>
-  <tbody>{rows_html}</tbody>
-  <tr><td colspan='3'><b>Total</b></td><td align='right'><b>{total_str}</b></td><td></td><td></td></tr>
+  <tbody>${rows}</tbody>
+  <tr><td colspan='3'><b>Total</b></td><td align='right'><b>${total}</b></td><td></td><td></td></tr>
 </table>
 
 <div style='font-size:9pt;padding:4px 0;font-style:italic;'>
-  This is a Delivery Challan only. No commercial value. Goods are being sent for {purpose.lower()}.
+  This is a Delivery Challan only. No commercial value. Goods are being sent for ${purpose_lower}.
 </div>
 
 <table style='margin-top:8px;'>
@@ -915,7 +2245,7 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
     </td>
     <td style='width:40%;text-align:center;'>
       for MIRU GRC C/O MIXD STUDIO BY RMT<br>
-      {sig_img}
+      ${sig_img}
       <b>Authorised Signatory</b>
     </td>
   </tr>
@@ -923,134 +2253,42 @@ th{{background:#f0f0f0;font-weight:bold;text-align:center;}}
 <div style='text-align:center;font-size:9pt;margin-top:6px;'>This is a Computer Generated Challan</div>
 </div></body></html>"""
 
-def build_html(data, signature_b64=None, watermark=False):
-    if data.get("doc_type") == "Tax Invoice":
-        return build_html_tax_invoice(data, signature_b64)
-    if data.get("doc_type") == "Challan":
-        return build_html_challan(data, signature_b64)
-
-    logo_b64 = img_b64("MIRU GRC _INDIAS FASTEST GROWING BRAND_Black.png")
-    logo_html = (f"<img src='data:image/png;base64,{logo_b64}' style='height:50px;'>"
-                 if logo_b64 else "<strong>MIXD STUDIO BY RMT</strong>")
-
-    items = data.get("items") or json.loads(data.get("items_json", "[]"))
-    terms = data.get("terms") or json.loads(data.get("terms_json", "[]"))
-
-    def _item_rows(items):
-        html = ""
-        for it in items:
-            qty         = float(it.get("qty", 0))
-            app         = float(it.get("area_per_piece", 0))
-            pcs         = float(it.get("pieces", 0))
-            # Show "X sqft × Y pcs = Z sqft" if area/pieces available, else just qty
-            if app > 0 and pcs > 0:
-                qty_cell = f"{app} × {pcs:.0f} = {format_inr(qty)}"
-            else:
-                qty_cell = format_inr(qty) if qty else "—"
-
-            unit = it.get("unit", "")
-
-            if it.get("sale_type") == "Supply & Installation" and (it.get("supply_rate") or it.get("install_rate")):
-                sr = float(it.get("supply_rate") or 0)
-                ir = float(it.get("install_rate") or 0)
-                if sr:
-                    html += (
-                        f"<tr><td>Supply</td><td>{it.get('hsn','')}</td><td>Supply of {it['desc']}</td>"
-                        f"<td>{qty_cell}</td><td>{unit}</td><td>₹{format_inr(sr)}</td>"
-                        f"<td>₹{format_inr(qty * sr)}</td></tr>"
-                    )
-                if ir:
-                    html += (
-                        f"<tr><td>Installation</td><td>{it.get('hsn','')}</td><td>Installation of {it['desc']}</td>"
-                        f"<td>{qty_cell}</td><td>{unit}</td><td>₹{format_inr(ir)}</td>"
-                        f"<td>₹{format_inr(qty * ir)}</td></tr>"
-                    )
-            else:
-                rate = float(it.get("rate", 0))
-                html += (
-                    f"<tr><td>{it.get('sale_type','')}</td><td>{it.get('hsn','')}</td><td>{it['desc']}</td>"
-                    f"<td>{qty_cell}</td><td>{unit}</td><td>₹{format_inr(rate)}</td>"
-                    f"<td>₹{format_inr(qty * rate)}</td></tr>"
-                )
-        return html
-
-    rows = _item_rows(items)
-
-    def _item_subtotal(items):
-        total = 0.0
-        for it in items:
-            qty = float(it.get("qty", 0))
-            if it.get("sale_type") == "Supply & Installation" and (it.get("supply_rate") or it.get("install_rate")):
-                total += qty * float(it.get("supply_rate") or 0)
-                total += qty * float(it.get("install_rate") or 0)
-            else:
-                total += qty * float(it.get("rate", 0))
-        return total
-
-    subtotal = _item_subtotal(items)
-    transport_amount = float(data.get("transport_amount", 0) or 0)
-    grand = round(subtotal * 1.18 + transport_amount)
-
-    validity_html = ""
-    if data.get("validity_date") and data.get("doc_type") == "Quotation":
-        validity_html = f"<p style='font-size:11px;margin:2px 0'><b>Valid Until:</b> {data['validity_date']}</p>"
-
-    ewb_html = ""
-    if data.get("doc_type") == "Tax Invoice" and (data.get("vehicle_no") or data.get("transporter_name")):
-        ewb_html = f"""
-        <div style='background:#f0f7ff;border:1px solid #c0d8f0;border-radius:4px;padding:8px 12px;margin-bottom:16px;font-size:11px;'>
-          <b>🚛 E-Way Bill Details</b>&nbsp;&nbsp;
-          Vehicle: <b>{data.get('vehicle_no','—')}</b>&nbsp;&nbsp;|&nbsp;&nbsp;
-          Transporter: <b>{data.get('transporter_name','—')}</b>&nbsp;&nbsp;|&nbsp;&nbsp;
-          Distance: <b>{data.get('distance_km','—')} km</b>&nbsp;&nbsp;|&nbsp;&nbsp;
-          Mode: <b>{data.get('transport_mode','Road')}</b>
-        </div>"""
-
-    sig_html = ""
-    if signature_b64:
-        sig_html = f"""
-        <div style='margin-top:50px;text-align:right;'>
-            <img src='data:image/png;base64,{signature_b64}' style='height:60px;'><br>
-            <small style='font-size:10px;'>Authorised Signatory: {data.get('approved_by','')}</small>
-        </div>"""
+# A page of a long bill is the full document cut after its item rows: the
+# header and column headings repeat, and the table ends with the running total.
+PAGE_LABEL_LAYOUT = _Layout("<span style='float:right;font-size:9pt;font-weight:normal;'>Page ${page} of ${pages}</span>")
+PAGE_CONT_TAIL    = """</tbody>
+</table>
+<div style='text-align:right;font-size:9pt;margin-top:6px;font-style:italic;'>Continued on page ${next_page}</div>
+</div></body></html>"""
 
-    terms_html = "".join(f"<p style='margin:3px 0'>{i+1}. {t}</p>" for i, t in enumerate(terms))
+TAX_INVOICE_LAYOUT      = _Layout(TAX_INVOICE_HTML)
+TAX_INVOICE_CONT_LAYOUT = _Layout(TAX_INVOICE_HTML.split("</tbody>")[0] + PAGE_CONT_TAIL)
+TI_FORWARD_LAYOUT       = _Layout("<tr><td></td><td colspan='5' style='font-style:italic'>${label}</td>"
+                                  "<td align='right'><b>${amount}</b></td></tr>")
+CHALLAN_LAYOUT          = _Layout(CHALLAN_HTML)
+CHALLAN_CONT_LAYOUT     = _Layout(CHALLAN_HTML.split("</tbody>")[0] + PAGE_CONT_TAIL)
+CHALLAN_FORWARD_LAYOUT  = _Layout("<tr><td></td><td colspan='2' style='font-style:italic'>${label}</td>"
+                                  "<td align='right'><b>${amount}</b></td><td></td><td></td></tr>")
 
-    # Bank details
-    try:
-        bank = get_settings()
-    except Exception:
-        bank = {}
-    bank_html = f"""
-<table style='width:60%;border-collapse:collapse;font-size:11px;'>
-  <tr><td colspan='2' style='font-weight:700;padding:4px 0;border-bottom:1px solid #ccc;'>BANK DETAILS</td></tr>
-  <tr><td style='padding:2px 8px 2px 0;color:#555;width:40%'>Bank Name</td><td><b>{bank.get('bank_name', DEFAULT_BANK['bank_name'])}</b></td></tr>
-  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Account Name</td><td><b>{bank.get('account_name', DEFAULT_BANK['account_name'])}</b></td></tr>
-  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Account Number</td><td><b>{bank.get('account_no', DEFAULT_BANK['account_no'])}</b></td></tr>
-  <tr><td style='padding:2px 8px 2px 0;color:#555;'>IFSC Code</td><td><b>{bank.get('ifsc', DEFAULT_BANK['ifsc'])}</b></td></tr>
-  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Branch</td><td>{bank.get('branch', DEFAULT_BANK['branch'])}</td></tr>
-  <tr><td style='padding:2px 8px 2px 0;color:#555;'>Account Type</td><td>{bank.get('account_type', DEFAULT_BANK['account_type'])}</td></tr>
-</table>"""
-
-    return f"""<!DOCTYPE html>
+QUOTATION_LAYOUT = _Layout("""<!DOCTYPE html>
 <html><head>
-<link href='https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap' rel='stylesheet'>
 <meta charset='UTF-8'>
 <style>
-@page {{margin:10mm 20mm 20mm 10mm;}}
-body{{font-family:'Poppins',sans-serif;background:#fff;font-size:13px;}}
-table{{width:100%;border-collapse:collapse;margin-bottom:16px;border:1px solid #ccc;}}
-th,td{{border:1px solid #ccc;padding:8px;text-align:left;}}
-th{{font-size:12px;background:#f5f5f5;}}
-td{{font-size:11px;}}
-.tot th,.tot td{{border:1px solid #ccc;padding:8px;text-align:right;font-size:11px;}}
-.watermark{{position:fixed;top:50%;left:50%;transform:translate(-50%,-50%) rotate(-45deg);
+${font_css}
+@page {margin:10mm 20mm 20mm 10mm;}
+body{font-family:'Poppins',Arial,sans-serif;background:#fff;font-size:13px;}
+table{width:100%;border-collapse:collapse;margin-bottom:16px;border:1px solid #ccc;}
+th,td{border:1px solid #ccc;padding:8px;text-align:left;}
+th{font-size:12px;background:#f5f5f5;}
+td{font-size:11px;}
+.tot th,.tot td{border:1px solid #ccc;padding:8px;text-align:right;font-size:11px;}
+.watermark{position:fixed;top:50%;left:50%;transform:translate(-50%,-50%) rotate(-45deg);
   font-size:90px;font-weight:900;color:rgba(255,0,0,0.12);white-space:nowrap;
-  pointer-events:none;z-index:9999;letter-spacing:8px;}}
+  pointer-events:none;z-index:9999;letter-spacing:8px;}
 </style>
 </head><body>
 <div style='display:flex;justify-content:space-between;align-items:center;margin-bottom:30px;'>
-  <div>{logo_html}</div>
+  <div>${logo}</div>
   <div style='text-align:right;'>
     <p style='margin:0;font-size:20px;font-weight:600;'>MIXD STUDIO BY RMT</p>
     <p style='margin:2px 0;font-size:11px;'>GST: 07ACDFM6440P1ZS</p>
@@ -1061,74 +2299,881 @@ td{{font-size:11px;}}
 
 <div style='display:flex;justify-content:space-between;align-items:flex-start;margin-bottom:24px;'>
   <div>
-    <p style='font-size:22px;font-weight:700;margin:0;'>{data['doc_type']}</p>
-    <p style='font-size:11px;color:#666;margin:2px 0;'>Doc No: {data['doc_id']}</p>
+    <p style='font-size:22px;font-weight:700;margin:0;'>${doc_type}</p>
+    <p style='font-size:11px;color:#666;margin:2px 0;'>Doc No: ${doc_id}</p>
   </div>
   <div style='text-align:right;'>
-    <p style='margin:2px 0;'><b>Date:</b> {data['doc_date']}</p>
-    {validity_html}
+    <p style='margin:2px 0;'><b>Date:</b> ${doc_date}</p>
+    ${validity}
   </div>
 </div>
 
 <div style='display:flex;justify-content:space-between;margin-bottom:30px;'>
   <div>
     <p style='margin:0;font-weight:600;'>RECIPIENT</p>
-    <p style='margin:4px 0;white-space:pre-wrap;max-width:280px;font-size:12px;'>{data['project_name']}
-{data['client_name']}
-{data['billing_address']}</p>
+    <p style='margin:4px 0;white-space:pre-wrap;max-width:280px;font-size:12px;'>${project_name}
+${client_name}
+${billing_address}</p>
   </div>
   <div style='text-align:right;'>
     <p style='margin:0;font-weight:600;'>DELIVERY ADDRESS</p>
-    <p style='margin:4px 0;white-space:pre-wrap;max-width:280px;font-size:12px;'>{data['delivery_address']}</p>
+    <p style='margin:4px 0;white-space:pre-wrap;max-width:280px;font-size:12px;'>${delivery_address}</p>
   </div>
 </div>
 
-{ewb_html}
+${ewb}
 <table>
   <thead><tr><th>TYPE</th><th>HSN</th><th>DESCRIPTION</th><th>AREA/PC × PCS = QTY</th><th>UNIT</th><th>RATE</th><th>AMOUNT</th></tr></thead>
-  <tbody>{rows}</tbody>
+  <tbody>${rows}</tbody>
 </table>
 
 <div style='display:flex;justify-content:flex-end;'>
   <table class='tot' style='width:45%;'>
-    <tr><th>Subtotal:</th><td>₹{format_inr(subtotal)}</td></tr>
-    <tr><th>CGST (9%):</th><td>₹{format_inr(subtotal*0.09)}</td></tr>
-    <tr><th>SGST (9%):</th><td>₹{format_inr(subtotal*0.09)}</td></tr>
-    <tr><th>Transportation:</th><td>{"₹" + format_inr(transport_amount) if transport_amount else "Included"}</td></tr>
-    <tr><th><b>Total (Rounded):</b></th><td><b>₹{format_inr(grand)}</b></td></tr>
+    <tr><th>Subtotal:</th><td>₹${subtotal}</td></tr>
+    <tr><th>CGST (9%):</th><td>₹${gst_half}</td></tr>
+    <tr><th>SGST (9%):</th><td>₹${gst_half}</td></tr>
+    <tr><th>Transportation:</th><td>${transport}</td></tr>
+    <tr><th><b>Total (Rounded):</b></th><td><b>₹${grand}</b></td></tr>
   </table>
 </div>
 
 <p style='font-size:11px;font-style:italic;margin-top:8px;'>
-  <b>Amount in Words:</b> Rupees {amount_in_words(grand)}
+  <b>Amount in Words:</b> Rupees ${grand_words}
 </p>
 
 <div style='margin-top:24px;display:flex;gap:40px;align-items:flex-start;'>
-  <div style='flex:1'>{bank_html}</div>
+  <div style='flex:1'>${bank}</div>
   <div style='flex:1;font-size:11px;'>
     <p style='font-weight:700;margin-bottom:4px;border-bottom:1px solid #ccc;padding-bottom:4px;'>TERMS &amp; CONDITIONS</p>
-    {terms_html}
+    ${terms}
   </div>
 </div>
 
-{sig_html}
+${sig}
 
 <p style='margin-top:30px;font-size:9px;color:#aaa;text-align:center;'>
-  Generated by MIRU Document Generator · {datetime.now().strftime('%d %b %Y %H:%M')}
+  Generated by MIRU Document Generator${generated_at}
 </p>
-{"<div class='watermark'>NOT APPROVED</div>" if watermark else ""}
-</body></html>"""
+${watermark}
+</body></html>""")
+
+def _client_gst(client_name):
+    """(GSTIN, state code, state name) of a client from the Clients sheet."""
+    try:
+        client_data  = next((c for c in get_clients() if c["name"] == client_name), {})
+        client_gstin = client_data.get("gst_number", "")
+    except Exception:
+        client_gstin = ""
+    client_code = client_gstin[:2] if len(client_gstin) >= 2 else ""
+    return client_gstin, client_code, STATE_NAMES.get(client_code, "")
+
+def _sig_img(signature_b64):
+    return SIG_IMG_LAYOUT.render({"sig": signature_b64}) if signature_b64 else NO_SIG_HTML
+
+def _tax_invoice_context(data, signature_b64=None, watermark=False):
+    """(layout context without the item rows, item row dicts) of a Tax Invoice.
+    Each row carries its amount as a number under "value"."""
+    items = data.get("items") or json.loads(data.get("items_json", "[]"))
+
+    client_gstin, client_code, client_state = _client_gst(data.get("client_name", ""))
+    seller_code = "08"
+    is_igst = client_code and client_code != seller_code
+
+    # Item rows + totals in one pass
+    rows       = []
+    subtotal   = 0.0
+    total_qty  = 0.0
+    total_unit = "Sqft"
+    hsn_main   = "68109990"
+
+    for it in items:
+        qty   = float(it.get("qty", 0))
+        total_qty += qty
+        total_unit = it.get("unit", "Sqft")
+        hsn   = it.get("hsn", "") or "68109990"
+        hsn_main = hsn
+        desc  = it.get("desc", "")
+        app   = float(it.get("area_per_piece", 0))
+        pcs   = float(it.get("pieces", 0))
+        stype = it.get("sale_type", "Supply")
+
+        sub  = f"<br><small style='font-size:8.5pt;'>Area of One Piece {app} {total_unit} ({int(pcs)} Pcs)</small>" if app > 0 and pcs > 0 else ""
+        line = {"hsn": hsn, "qty": format_inr(qty), "unit": total_unit}
+
+        if stype == "Supply & Installation" and (it.get("supply_rate") or it.get("install_rate")):
+            sr = float(it.get("supply_rate") or 0)
+            ir = float(it.get("install_rate") or 0)
+            if sr:
+                subtotal += qty * sr
+                rows.append({**line, "desc": f"Supply of {desc}", "sub": sub, "value": qty * sr,
+                             "rate": format_inr(sr), "amount": format_inr(qty * sr)})
+            if ir:
+                subtotal += qty * ir
+                rows.append({**line, "desc": f"Installation of {desc}", "sub": "", "value": qty * ir,
+                             "rate": format_inr(ir), "amount": format_inr(qty * ir)})
+        else:
+            rate = float(it.get("rate", 0))
+            subtotal += qty * rate
+            rows.append({**line, "desc": desc, "sub": sub, "value": qty * rate,
+                         "rate": format_inr(rate), "amount": format_inr(qty * rate)})
+    for sl, r in enumerate(rows, 1):
+        r["sl"] = sl
+
+    transport_amount = float(data.get("transport_amount", 0) or 0)
+    tax_amount  = subtotal * 0.18
+    grand_pre   = subtotal + tax_amount + transport_amount
+    grand       = round(grand_pre)
+    round_off   = grand - grand_pre
+
+    # Tax rows inside items table, and the HSN-wise tax summary
+    if is_igst:
+        tax_rows  = TI_TAX_ROW_LAYOUT.render({"tax": "IGST", "pct": 18, "amount": format_inr(tax_amount)})
+        tax_table = TI_IGST_LAYOUT.render({"hsn": hsn_main, "taxable": format_inr(subtotal),
+                                           "tax": format_inr(tax_amount)})
+    else:
+        cgst      = format_inr(subtotal * 0.09)
+        tax_rows  = TI_TAX_ROW_LAYOUT.render_rows([{"tax": "CGST", "pct": 9, "amount": cgst},
+                                                   {"tax": "SGST", "pct": 9, "amount": cgst}])
+        tax_table = TI_CGST_LAYOUT.render({"hsn": hsn_main, "taxable": format_inr(subtotal),
+                                           "half": cgst, "tax": format_inr(tax_amount)})
+
+    delivery = data.get("delivery_address", "") or ""
+    return {
+        "doc_id":         data["doc_id"],
+        "doc_date":       data["doc_date"],
+        "project_name":   data.get("project_name", ""),
+        "client_name":    data["client_name"],
+        "transport_mode": data.get("transport_mode", "Road"),
+        "transporter":    data.get("transporter_name", "") or "",
+        "vehicle_no":     data.get("vehicle_no", "") or "",
+        "delivery_dest":  delivery.split("\n")[0],
+        "delivery_addr":  delivery.replace("\n", "<br>"),
+        "billing_addr":   (data.get("billing_address", "") or "").replace("\n", "<br>"),
+        "gstin_line":     f"GSTIN/UIN: {client_gstin}<br>" if client_gstin else "",
+        "state_line":     f"State Name: {client_state}, Code: {client_code}" if client_state else "",
+        "tax_rows":       tax_rows,
+        "round_off":      f"{round_off:+.2f}" if abs(round_off) > 0.001 else "0.00",
+        "total_qty":      format_inr(total_qty),
+        "total_unit":     total_unit,
+        "grand":          format_inr(grand),
+        "grand_words":    amount_in_words(grand),
+        "tax_table":      tax_table,
+        "tax_words":      amount_in_words(int(tax_amount)),
+        "sig_img":        _sig_img(signature_b64),
+        "watermark":      WATERMARK_HTML if watermark else "",
+    }, rows
+
+def _ti_carried(rows):
+    return format_inr(sum(r["value"] for r in rows))
+
+def build_html_tax_invoice(data, signature_b64=None, watermark=False):
+    """GST Tax Invoice — matches the standard Indian format."""
+    ctx, rows = _tax_invoice_context(data, signature_b64, watermark)
+    return TAX_INVOICE_LAYOUT.render({**ctx, "rows": TI_ROW_LAYOUT.render_rows(rows), "page_label": ""})
+
+def _challan_context(data, signature_b64=None, watermark=False):
+    """(layout context without the item rows, item row dicts) of a Delivery
+    Challan. Each row carries (unit, qty) under "value"."""
+    items = data.get("items") or json.loads(data.get("items_json", "[]"))
+    client_gstin, client_code, client_state = _client_gst(data.get("client_name", ""))
+    purpose = data.get("notes", "Supply") or "Supply"
+
+    # Item rows (no rates)
+    rows = []
+    for sl, it in enumerate(items, 1):
+        qty  = float(it.get("qty", 0))
+        unit = it.get("unit", "Sqft")
+        app  = float(it.get("area_per_piece", 0))
+        pcs  = float(it.get("pieces", 0))
+        rows.append({
+            "sl": sl, "desc": it.get("desc", ""), "hsn": it.get("hsn", "") or "68109990",
+            "sub": f"<br><small style='font-size:8.5pt;'>Area of One Piece: {app} {unit} × {int(pcs)} Pcs</small>" if app > 0 and pcs > 0 else "",
+            "qty": format_inr(qty), "unit": unit, "remarks": it.get("remarks", ""), "value": (unit, qty),
+        })
+
+    return {
+        "doc_id":         data["doc_id"],
+        "doc_date":       data["doc_date"],
+        "project_name":   data.get("project_name", ""),
+        "client_name":    data["client_name"],
+        "purpose":        purpose,
+        "purpose_lower":  purpose.lower(),
+        "vehicle_no":     data.get("vehicle_no", "") or "",
+        "transporter":    data.get("transporter_name", "") or "",
+        "transport_mode": data.get("transport_mode", "Road") or "Road",
+        "delivery_addr":  (data.get("delivery_address", "") or "").replace("\n", "<br>"),
+        "billing_addr":   (data.get("billing_address",  "") or "").replace("\n", "<br>"),
+        "gstin_line":     f"GSTIN/UIN: {client_gstin}<br>" if client_gstin else "",
+        "state_line":     f"State Name: {client_state}, Code: {client_code}" if client_state else "",
+        "total":          _challan_carried(rows),
+        "sig_img":        _sig_img(signature_b64),
+        "watermark":      WATERMARK_HTML if watermark else "",
+    }, rows
+
+def _challan_carried(rows):
+    total_qty = {}   # unit → qty
+    for r in rows:
+        unit, qty = r["value"]
+        total_qty[unit] = total_qty.get(unit, 0) + qty
+    return " | ".join(f"{format_inr(v)} {u}" for u, v in total_qty.items())
+
+def build_html_challan(data, signature_b64=None, watermark=False):
+    """Delivery Challan — dispatch details only, no rates or amounts."""
+    ctx, rows = _challan_context(data, signature_b64, watermark)
+    return CHALLAN_LAYOUT.render({**ctx, "rows": CHALLAN_ROW_LAYOUT.render_rows(rows), "page_label": ""})
+
+# Long bills print as separate page documents. Every page repeats the header
+# and column headings; pages after the first open with the total brought
+# forward and all but the last close with the total carried forward. Pages
+# before the last take PAGE_ROWS items; the last, which also carries the
+# totals, takes what is left up to LAST_PAGE_ROWS. When that would overflow
+# it, the earlier pages share the rest evenly instead of leaving one short.
+SINGLE_PAGE_ROWS = 20
+PAGE_ROWS        = 18
+LAST_PAGE_ROWS   = 10
+
+def _paginate(rows):
+    n = len(rows)
+    if n <= SINGLE_PAGE_ROWS:
+        return [rows]
+    k = -(-(n - LAST_PAGE_ROWS) // PAGE_ROWS)   # pages before the last
+    if n - k * PAGE_ROWS >= 1:
+        sizes = [PAGE_ROWS] * k
+    else:
+        head  = n - LAST_PAGE_ROWS
+        sizes = [head // k + (i < head % k) for i in range(k)]
+    chunks, start = [], 0
+    for size in sizes:
+        chunks.append(rows[start:start + size])
+        start += size
+    return chunks + [rows[start:]]
+
+def _render_pages(ctx, rows, layout, cont_layout, row_layout, forward_layout, carried):
+    chunks = _paginate(rows)
+    if len(chunks) == 1:
+        return [layout.render({**ctx, "rows": row_layout.render_rows(rows), "page_label": ""})]
+    pages, done, forward = [], 0, ""
+    for n, chunk in enumerate(chunks, 1):
+        body  = row_layout.render_rows(chunk)
+        if done:
+            body = forward_layout.render({"label": "Brought forward", "amount": forward}) + body
+        done += len(chunk)
+        page  = {**ctx, "page_label": PAGE_LABEL_LAYOUT.render({"page": n, "pages": len(chunks)})}
+        if n == len(chunks):
+            pages.append(layout.render({**page, "rows": body}))
+            break
+        forward = carried(rows[:done])
+        body   += forward_layout.render({"label": "Carried forward", "amount": forward})
+        pages.append(cont_layout.render({**page, "rows": body, "next_page": n + 1}))
+    return pages
+
+def build_pages(data, signature_b64=None, watermark=False, generated_at=None):
+    """The document as a list of page-sized HTML documents that render on
+    their own. Tax invoices and challans paginate; a quotation is one page."""
+    if data.get("doc_type") == "Tax Invoice":
+        return _render_pages(*_tax_invoice_context(data, signature_b64, watermark), TAX_INVOICE_LAYOUT,
+                             TAX_INVOICE_CONT_LAYOUT, TI_ROW_LAYOUT, TI_FORWARD_LAYOUT, _ti_carried)
+    if data.get("doc_type") == "Challan":
+        return _render_pages(*_challan_context(data, signature_b64, watermark), CHALLAN_LAYOUT,
+                             CHALLAN_CONT_LAYOUT, CHALLAN_ROW_LAYOUT, CHALLAN_FORWARD_LAYOUT, _challan_carried)
+    return [build_html(data, signature_b64, watermark, generated_at)]
+
+def _footer_time(when):
+    """' · 18 Oct 2026 14:05' for a datetime or ISO string, now when not given,
+    and nothing for any other value — a cell is never printed as it stands."""
+    when = datetime.now() if when is None else _iso_time(when)
+    return f" · {when:%d %b %Y %H:%M}" if when else ""
+
+def _approval_time(rec):
+    """The footer time of an approved document: approved_at, or created_at
+    when approved_at isn't a timestamp, or "" (none shown) when neither is."""
+    for col in ("approved_at", "created_at"):
+        if _iso_time(rec.get(col)):
+            return rec[col]
+    return ""
+
+def _quote_rows(items):
+    rows = []
+    for it in items:
+        qty = float(it.get("qty", 0))
+        app = float(it.get("area_per_piece", 0))
+        pcs = float(it.get("pieces", 0))
+        # Show "X sqft × Y pcs = Z sqft" if area/pieces available, else just qty
+        line = {"hsn": it.get("hsn", ""), "unit": it.get("unit", ""),
+                "qty": f"{app} × {pcs:.0f} = {format_inr(qty)}" if app > 0 and pcs > 0 else (format_inr(qty) if qty else "—")}
+        if it.get("sale_type") == "Supply & Installation" and (it.get("supply_rate") or it.get("install_rate")):
+            sr = float(it.get("supply_rate") or 0)
+            ir = float(it.get("install_rate") or 0)
+            if sr:
+                rows.append({**line, "type": "Supply", "desc": f"Supply of {it['desc']}",
+                             "rate": format_inr(sr), "amount": format_inr(qty * sr)})
+            if ir:
+                rows.append({**line, "type": "Installation", "desc": f"Installation of {it['desc']}",
+                             "rate": format_inr(ir), "amount": format_inr(qty * ir)})
+        else:
+            rate = float(it.get("rate", 0))
+            rows.append({**line, "type": it.get("sale_type", ""), "desc": it["desc"],
+                         "rate": format_inr(rate), "amount": format_inr(qty * rate)})
+    return rows
+
+def _item_subtotal(items):
+    total = 0.0
+    for it in items:
+        qty = float(it.get("qty", 0))
+        if it.get("sale_type") == "Supply & Installation" and (it.get("supply_rate") or it.get("install_rate")):
+            total += qty * float(it.get("supply_rate") or 0)
+            total += qty * float(it.get("install_rate") or 0)
+        else:
+            total += qty * float(it.get("rate", 0))
+    return total
+
+def build_html(data, signature_b64=None, watermark=False, generated_at=None):
+    """generated_at fixes the footer timestamp (pass approved_at for approved
+    documents) so the same document always renders to the same HTML."""
+    if data.get("doc_type") == "Tax Invoice":
+        return build_html_tax_invoice(data, signature_b64, watermark)
+    if data.get("doc_type") == "Challan":
+        return build_html_challan(data, signature_b64, watermark)
+
+    logo_b64 = img_b64(LOGO_PATH, LOGO_HEIGHT)
+    logo_html = (f"<img src='data:image/png;base64,{logo_b64}' style='height:{LOGO_HEIGHT}px;'>"
+                 if logo_b64 else "<strong>MIXD STUDIO BY RMT</strong>")
+
+    items = data.get("items") or json.loads(data.get("items_json", "[]"))
+    terms = data.get("terms") or json.loads(data.get("terms_json", "[]"))
+
+    subtotal = _item_subtotal(items)
+    transport_amount = float(data.get("transport_amount", 0) or 0)
+    grand = round(subtotal * 1.18 + transport_amount)
+
+    validity_html = ""
+    if data.get("validity_date") and data.get("doc_type") == "Quotation":
+        validity_html = QUOTE_VALIDITY_LAYOUT.render(data)
+
+    ewb_html = ""
+    if data.get("doc_type") == "Tax Invoice" and (data.get("vehicle_no") or data.get("transporter_name")):
+        ewb_html = QUOTE_EWB_LAYOUT.render({f: data.get(f, "—") for f in ("vehicle_no", "transporter_name", "distance_km")}
+                                           | {"transport_mode": data.get("transport_mode", "Road")})
+
+    sig_html = ""
+    if signature_b64:
+        sig_html = QUOTE_SIG_LAYOUT.render({"sig": signature_b64, "approved_by": data.get("approved_by", "")})
+
+    # Bank details
+    try:
+        bank = get_settings()
+    except Exception:
+        bank = {}
+
+    return QUOTATION_LAYOUT.render({
+        "font_css":         font_face_css(),
+        "logo":             logo_html,
+        "doc_type":         data["doc_type"],
+        "doc_id":           data["doc_id"],
+        "doc_date":         data["doc_date"],
+        "validity":         validity_html,
+        "project_name":     data["project_name"],
+        "client_name":      data["client_name"],
+        "billing_address":  data["billing_address"],
+        "delivery_address": data["delivery_address"],
+        "ewb":              ewb_html,
+        "rows":             QUOTE_ROW_LAYOUT.render_rows(_quote_rows(items)),
+        "subtotal":         format_inr(subtotal),
+        "gst_half":         format_inr(subtotal * 0.09),
+        "transport":        "₹" + format_inr(transport_amount) if transport_amount else "Included",
+        "grand":            format_inr(grand),
+        "grand_words":      amount_in_words(grand),
+        "bank":             QUOTE_BANK_LAYOUT.render({k: bank.get(k, v) for k, v in DEFAULT_BANK.items()}),
+        "terms":            QUOTE_TERM_LAYOUT.render_rows({"n": i + 1, "term": t} for i, t in enumerate(terms)),
+        "sig":              sig_html,
+        "generated_at":     _footer_time(generated_at),
+        "watermark":        WATERMARK_HTML if watermark else "",
+    })
+
+# ── Previews ───────────────────────────────────────────────────────────────────
+#
+# On-screen previews are cached across reruns and sessions, keyed by doc id and
+# a digest of everything build_html() reads: the fields, the client's GSTIN
+# and the settings. Watermarked and signed variants are separate entries.
+
+def _digest(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+@st.cache_data(max_entries=200, show_spinner=False)
+def _cached_preview(doc_id, digest, watermark, sig_digest, _data, _signature_b64, _generated_at):
+    return build_html(_data, _signature_b64, watermark, _generated_at)
+
+def preview_html(data, signature_b64=None, watermark=False, generated_at=None):
+    """build_html() for display, reused while the document is unchanged."""
+    inputs = {"data": data, "generated_at": generated_at,
+              "client": _client_gst(data.get("client_name", "")),
+              "settings": get_settings() if data.get("doc_type") not in ("Tax Invoice", "Challan") else None}
+    return _cached_preview(str(data.get("doc_id", "")), _digest(inputs), bool(watermark),
+                           _digest(signature_b64) if signature_b64 else "",
+                           data, signature_b64, generated_at)
+
+# ── PDF rendering ──────────────────────────────────────────────────────────────
+#
+# make_pdf(html) -> bytes goes through RenderClient: the engine named in the
+# [pdf] secrets section (engine = "pdfshift" | "wkhtmltopdf", default pdfshift)
+# and then its fallback (default wkhtmltopdf, which apt-packages.txt installs;
+# fallback = "" disables it). Transient errors are retried with
+# backoff; an engine that keeps failing is skipped by its circuit breaker for
+# a cooldown. Results are cached on disk by a hash of the HTML, so a document
+# whose HTML hasn't changed (anything approved) is rendered once. A fallback
+# render is served but never cached or stored as an artifact: wkhtmltopdf's
+# QtWebKit can't lay out the quotation's flexbox, so the PDF is rendered again
+# on the next request, by the primary engine once its breaker lets it through.
+
+class PdfShiftEngine:
+    """pdfshift.io over one keep-alive requests.Session, so renders reuse
+    connections instead of paying a TLS handshake each."""
+
+    URL = "https://api.pdfshift.io/v3/convert/pdf"
+
+    def __init__(self, api_key, timeout=30, pool=4):
+        self.timeout = float(timeout)
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=int(pool)))
+        self.session.headers.update({"X-API-Key": api_key, "Content-Type": "application/json"})
+
+    def __call__(self, html):
+        resp = self.session.post(self.URL, json={"source": html, "sandbox": False}, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.content
+
+class WkhtmltopdfEngine:
+    """Renders with a local wkhtmltopdf binary (apt-packages.txt), one process per
+    document, at most `workers` at a time; further callers queue for a slot."""
+
+    # @page margins aren't honoured by wkhtmltopdf, so pass ours on the command line
+    OPTIONS = ["--quiet", "--encoding", "utf-8", "--page-size", "A4", "--print-media-type",
+               "--margin-top", "8mm", "--margin-bottom", "8mm",
+               "--margin-left", "10mm", "--margin-right", "10mm"]
+
+    def __init__(self, binary="wkhtmltopdf", workers=2, timeout=60):
+        self.binary  = shutil.which(binary) or binary
+        self.timeout = float(timeout)
+        self._slots  = threading.BoundedSemaphore(max(1, int(workers)))
+
+    def __call__(self, html):
+        with self._slots:
+            proc = subprocess.run([self.binary, *self.OPTIONS, "-", "-"],
+                                  input=html.encode("utf-8"), capture_output=True,
+                                  timeout=self.timeout)
+        # wkhtmltopdf exits 1 on recoverable page errors (e.g. an unreachable font) but still writes the PDF
+        if not proc.stdout.startswith(b"%PDF") or proc.returncode not in (0, 1):
+            err = proc.stderr.decode("utf-8", "replace").strip()
+            raise RuntimeError(f"wkhtmltopdf exited {proc.returncode}: {err[-300:]}")
+        return proc.stdout
+
+class _CircuitBreaker:
+    """Opens after `threshold` failures in a row. While open the engine is
+    skipped; after `cooldown` seconds calls are let through again, and the
+    first success closes it."""
+
+    def __init__(self, threshold=3, cooldown=60):
+        self.threshold = int(threshold)
+        self.cooldown  = float(cooldown)
+        self.failures  = 0
+        self.opened_at = None
+        self._lock     = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.cooldown else "half-open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures, self.opened_at = 0, None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+class RenderClient:
+    """HTML → PDF through a chain of engines, at most max_concurrency at once.
+    Each engine call is retried on 429/5xx/transport errors and guarded by a
+    circuit breaker; latency and outcome of every call are recorded."""
+
+    def __init__(self, engines, max_concurrency=4, retries=2, threshold=3, cooldown=60):
+        self.engines  = [(name, render, _CircuitBreaker(threshold, cooldown)) for name, render in engines]
+        self.primary  = self.engines[0][0]
+        self.retries  = int(retries)
+        self.workers  = int(max_concurrency)
+        self.stats    = collections.defaultdict(collections.Counter)
+        self.latency  = collections.defaultdict(lambda: collections.deque(maxlen=500))
+        self._slots   = threading.BoundedSemaphore(self.workers)
+        self._lock    = threading.Lock()
+        self._pool    = None
+
+    def _count(self, name, key):
+        with self._lock:
+            self.stats[name][key] += 1
+
+    def render(self, html):
+        """(PDF bytes, name of the engine that rendered them)."""
+        # Every breaker open: still try the last engine rather than fail outright
+        chain = [e for e in self.engines if e[2].allow()] or self.engines[-1:]
+        with self._slots:
+            for i, (name, render, breaker) in enumerate(chain):
+                t0 = time.monotonic()
+                try:
+                    pdf = _with_backoff(lambda: render(html), retries=self.retries,
+                                        on_retry=lambda status: self._count(name, "retries"))
+                except Exception:
+                    breaker.record(False)
+                    self._count(name, "failures")
+                    if i == len(chain) - 1:
+                        raise
+                    continue
+                breaker.record(True)
+                self._count(name, "calls")
+                with self._lock:
+                    self.latency[name].append(time.monotonic() - t0)
+                return pdf, name
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on the client's own pool; returns a Future."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = _ctx_pool(self.workers, "render")
+        return self._pool.submit(fn, *args)
+
+    def report(self):
+        """One row per engine for the Settings tab."""
+        rows = []
+        for name, _, breaker in self.engines:
+            lat = sorted(self.latency[name])
+            pct = lambda q: f"{lat[min(len(lat) - 1, int(q * len(lat)))] * 1000:.0f}" if lat else "—"
+            rows.append({"engine": name, "breaker": breaker.state,
+                         "ok": self.stats[name]["calls"], "failed": self.stats[name]["failures"],
+                         "retries": self.stats[name]["retries"], "p50 ms": pct(0.5), "p95 ms": pct(0.95)})
+        return rows
+
+@st.cache_resource
+def _render_client():
+    cfg = dict(st.secrets.get("pdf", {}))
+    def build(name):
+        if name == "wkhtmltopdf":
+            return WkhtmltopdfEngine(cfg.get("wkhtmltopdf_path", "wkhtmltopdf"),
+                                     cfg.get("workers", 2), cfg.get("timeout", 60))
+        if name == "pdfshift":
+            return PdfShiftEngine(dict(st.secrets.get("pdfshift", {})).get("api_key", ""),
+                                  cfg.get("pdfshift_timeout", 30), cfg.get("max_concurrency", 4))
+        raise ValueError(f"Unknown PDF engine {name!r} in [pdf] secrets")
+    primary  = cfg.get("engine", "pdfshift")
+    fallback = cfg.get("fallback", "wkhtmltopdf")
+    names    = [primary] + ([fallback] if fallback and fallback != primary else [])
+    return RenderClient([(n, build(n)) for n in names], cfg.get("max_concurrency", 4),
+                        cfg.get("retries", 2), cfg.get("breaker_threshold", 3),
+                        cfg.get("breaker_cooldown", 60))
+
+class PdfCache:
+    """Content-addressed PDF files under `path`, evicted least-recently-used once
+    they add up to more than max_mb. A hit refreshes the file's mtime, which is
+    the LRU clock, so the cache survives restarts."""
+
+    def __init__(self, path=".pdf_cache", max_mb=200):
+        self.path      = path
+        self.max_bytes = int(float(max_mb) * 1024 * 1024)
+        self._lock     = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.pdf")
+
+    def get(self, key):
+        try:
+            with open(self._file(key), "rb") as f:
+                pdf = f.read()
+            os.utime(self._file(key))
+            return pdf
+        except OSError:
+            return None
+
+    def put(self, key, pdf):
+        tmp = self._file(key) + f".{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(pdf)
+        os.replace(tmp, self._file(key))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            for e in os.scandir(self.path):
+                if e.name.endswith(".pdf"):
+                    info = e.stat()
+                    files.append((info.st_mtime, info.st_size, e.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+@st.cache_resource
+def _pdf_cache():
+    cfg = dict(st.secrets.get("pdf", {}))
+    return PdfCache(cfg.get("cache_dir", ".pdf_cache"), cfg.get("cache_mb", 200))
+
+def _make_pdf(html):
+    """(PDF bytes, final): final is False for a fallback engine's render,
+    which is not cached."""
+    cache = _pdf_cache()
+    key   = hashlib.sha256(html.encode("utf-8")).hexdigest()
+    pdf   = cache.get(key)
+    if pdf is not None:
+        return pdf, True
+    client      = _render_client()
+    pdf, engine = client.render(html)
+    if engine != client.primary:
+        return pdf, False
+    cache.put(key, pdf)
+    return pdf, True
 
 def make_pdf(html):
-    resp = requests.post(
-        "https://api.pdfshift.io/v3/convert/pdf",
-        headers={"X-API-Key": st.secrets["pdfshift"]["api_key"],
-                 "Content-Type": "application/json"},
-        json={"source": html, "sandbox": False},
-        timeout=30,
-    )
-    resp.raise_for_status()
-    return resp.content
+    return _make_pdf(html)[0]
+
+def make_pdf_async(html):
+    """make_pdf() on the render pool; returns a Future of the bytes."""
+    return _render_client().submit(make_pdf, html)
+
+def merge_pdfs(parts):
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(io.BytesIO(part))
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def _make_pdf_pages(pages):
+    """(PDF bytes, final) for build_pages() output; final only if every page is."""
+    if len(pages) == 1:
+        return _make_pdf(pages[0])
+    parts = [f.result() for f in [_render_client().submit(_make_pdf, p) for p in pages]]
+    return merge_pdfs([pdf for pdf, _ in parts]), all(final for _, final in parts)
+
+def make_pdf_pages(pages):
+    """One PDF from build_pages() output. Pages render (and cache) separately,
+    in parallel on the render pool, and are merged in order."""
+    return _make_pdf_pages(pages)[0]
+
+# ── Artifacts ──────────────────────────────────────────────────────────────────
+#
+# The signed PDF of an approved document, or of a finalized dispatch, is
+# rendered once in the background and kept in the artifact store. The row's
+# pdf_sha256 column names the file. Downloads and email attachments read it
+# from there rather than rendering again. A document sent for approval has its
+# previews warmed on the same pool.
+
+class ArtifactStore:
+    """Immutable PDFs stored by SHA-256 under `path` — a local directory
+    standing in for an object store — plus a small pool that renders them."""
+
+    def __init__(self, path="artifacts", workers=2):
+        self.path  = path
+        self._pool = ThreadPoolExecutor(max_workers=int(workers), thread_name_prefix="artifact")
+        self._jobs = {}
+        self._failed = {}
+        self._provisional = set()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, sha):
+        return os.path.join(self.path, f"{sha}.pdf")
+
+    def put(self, pdf):
+        sha = hashlib.sha256(pdf).hexdigest()
+        if not os.path.exists(self._file(sha)):
+            tmp = self._file(sha) + f".{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp, self._file(sha))
+        return sha
+
+    def get(self, sha):
+        try:
+            with open(self._file(sha), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def has(self, sha):
+        return os.path.exists(self._file(sha))
+
+    def submit(self, key, fn):
+        """Run fn in the pool unless a job for key is already queued or running."""
+        with self._lock:
+            fut = self._jobs.get(key)
+            if fut is not None:
+                return fut
+            fut = self._jobs[key] = self._pool.submit(fn)
+            self._failed.pop(key, None)
+        fut.add_done_callback(lambda f: self._drop(key, f))   # may run right here if fn already finished
+        return fut
+
+    def _drop(self, key, fut):
+        with self._lock:
+            if self._jobs.get(key) is fut:
+                del self._jobs[key]
+                if not fut.cancelled() and fut.exception() is not None:
+                    self._failed[key] = str(fut.exception())
+
+    def provisional(self, key, flag):
+        """Mark whether key's last job only got a fallback render, which isn't stored."""
+        with self._lock:
+            (self._provisional.add if flag else self._provisional.discard)(key)
+
+    def status(self, key):
+        """'queued' or 'rendering' while a job for key is pending, 'failed: …'
+        when the last one raised, 'provisional' when it only got a fallback
+        render, None otherwise."""
+        with self._lock:
+            fut = self._jobs.get(key)
+            if fut is not None:
+                return "rendering" if fut.running() else "queued"
+            err = self._failed.get(key)
+            if not err and key in self._provisional:
+                return "provisional"
+        return f"failed: {err}" if err else None
+
+@st.cache_resource
+def _artifacts():
+    cfg = dict(st.secrets.get("artifacts", {}))
+    return ArtifactStore(cfg.get("path", "artifacts"), cfg.get("workers", 2))
+
+def _final_pages(table, rec):
+    if table == "Dispatches":
+        return build_pages(challan_data(rec))
+    return build_pages(rec, rec.get("signature_b64") or None, generated_at=_approval_time(rec))
+
+def persist_pdf(table, key):
+    """Render the final PDF of a Documents or Dispatches row in the background,
+    store it and point the row's pdf_sha256 at it. Returns a Future of the bytes.
+    A fallback engine's render is returned but not stored, so the next call
+    renders it again. A job already pending for the row is reused, so the job
+    renders again if the row changed under it, and only stores a PDF of the
+    row as it stands."""
+    store   = _artifacts()
+    ctx     = get_script_run_ctx()
+    headers = DOC_HEADERS if table == "Documents" else DISPATCH_HEADERS
+    inputs  = lambda rec: {k: v for k, v in rec.items() if k != "pdf_sha256"}
+    def job():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        for _ in range(3):
+            row = _fetch_snapshot().index(table).get(key)
+            rec = get_document(key) if table == "Documents" else get_dispatch(key)
+            pdf, final = _make_pdf_pages(_final_pages(table, rec))
+            snap = _fetch_snapshot()
+            hit  = snap.index(table).get(key)
+            if hit and row and inputs(hit[1]) != inputs(row[1]):
+                continue   # re-approved while rendering (this job was handed out again) — render the row as it is now
+            store.provisional((table, key), not final)
+            if final and hit:
+                sha = store.put(pdf)
+                if hit[1].get("pdf_sha256") != sha:
+                    _sheet_update(table, _a1(headers, "pdf_sha256", hit[0]), [[sha]], snap)
+            return pdf
+        return pdf   # the row kept changing — serve the last render, store nothing
+    return store.submit((table, key), job)
+
+def final_pdf(table, key):
+    """The stored PDF of an approved document / finalized dispatch. Waits for
+    one that is still rendering, and backfills rows approved before the store."""
+    rec = get_document(key) if table == "Documents" else get_dispatch(key)
+    sha = str(rec.get("pdf_sha256", "") or "") if rec else ""
+    pdf = _artifacts().get(sha) if sha else None
+    return pdf if pdf is not None else persist_pdf(table, key).result()
+
+def render_status(table, key):
+    """'ready' once the final PDF is stored; otherwise the render job's status
+    ('queued', 'rendering', 'failed: …', 'provisional'), or 'missing' when
+    none is pending."""
+    rec = get_document(key) if table == "Documents" else get_dispatch(key)
+    sha = str(rec.get("pdf_sha256", "") or "") if rec else ""
+    if sha and _artifacts().has(sha):
+        return "ready"
+    return _artifacts().status((table, key)) or "missing"
+
+def prerender(doc_id):
+    """Warm the preview cache for a document sent for approval: the plain page
+    the approval link shows and the watermarked one the documents tab shows.
+    No PDF — nothing is served from one until the document is signed."""
+    ctx = get_script_run_ctx()
+    def job():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        d = get_document(doc_id)
+        if not d:
+            return None
+        preview_html(d)
+        return preview_html(d, watermark=True)
+    return _artifacts().submit(("Preview", doc_id), job)
+
+# ── Bulk export ────────────────────────────────────────────────────────────────
+
+def document_pdf(doc_id):
+    """The stored PDF of an approved document; a watermarked render of anything else."""
+    d = get_document(doc_id)
+    if d["status"] == "Approved":
+        return final_pdf("Documents", doc_id)
+    return make_pdf_pages(build_pages(d, watermark=True))
+
+def export_documents_zip(docs, workers=4, on_progress=None):
+    """Render docs on a bounded pool and write each PDF into a ZIP as it
+    finishes. A failed render is skipped and reported, not fatal.
+    Returns (zip bytes, {doc_id: error})."""
+    buf, failed = io.BytesIO(), {}
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf, _ctx_pool(workers, "export") as pool:
+        futs = {pool.submit(document_pdf, d["doc_id"]): d for d in docs}
+        for done, fut in enumerate(as_completed(futs), 1):
+            d = futs[fut]
+            try:
+                zf.writestr(f"{d['doc_id']}_{str(d.get('client_name','')).replace(' ','_')}.pdf", fut.result())
+            except Exception as e:
+                failed[d["doc_id"]] = str(e)
+            if on_progress:
+                on_progress(done, len(futs))
+    return buf.getvalue(), failed
+
+def print_challans(dispatch_ids, combined=True, workers=4, on_progress=None):
+    """Challans of finalized dispatches, in the order given. Stored artifacts
+    are reused; the rest render concurrently. Returns (one merged PDF, or a
+    ZIP of one PDF each, {dispatch_id: error})."""
+    pdfs, failed = {}, {}
+    def one(key):
+        disp = get_dispatch(key)
+        if not disp or disp.get("status") != "Finalized":
+            raise ValueError("not finalized")
+        return disp, final_pdf("Dispatches", key)
+    with _ctx_pool(workers, "challans") as pool:
+        futs = {pool.submit(one, k): k for k in dispatch_ids}
+        for done, fut in enumerate(as_completed(futs), 1):
+            try:
+                pdfs[futs[fut]] = fut.result()
+            except Exception as e:
+                failed[futs[fut]] = str(e)
+            if on_progress:
+                on_progress(done, len(futs))
+    ordered = [pdfs[k] for k in dispatch_ids if k in pdfs]
+    if combined:
+        return (merge_pdfs([pdf for _, pdf in ordered]) if ordered else b""), failed
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for disp, pdf in ordered:
+            zf.writestr(f"{disp['dispatch_id']}_{str(disp.get('client_name','')).replace(' ','_')}.pdf", pdf)
+    return buf.getvalue(), failed
 
 # ── Approval page ──────────────────────────────────────────────────────────────
 
@@ -1145,15 +3190,30 @@ def approval_page(doc_id, token):
 
     if doc["status"] == "Approved":
         st.success(f"✅ Already approved by **{doc['approved_by']}** on {str(doc['approved_at'])[:10]}.")
-        html = build_html(doc, doc.get("signature_b64") or None)
-        pdf = make_pdf(html)
-        st.download_button("📥 Download Approved PDF", pdf,
-                           file_name=f"{doc_id}_{doc['client_name'].replace(' ','_')}.pdf")
+        html   = preview_html(doc, doc.get("signature_b64") or None, generated_at=_approval_time(doc))
+        status = render_status("Documents", doc_id)
+        if status in ("ready", "provisional"):
+            if status == "provisional":
+                st.warning("The PDF service is down; this copy comes from the backup renderer and "
+                           "its layout may differ. The final PDF is rendered once the service is back.")
+            st.download_button("📥 Download Approved PDF", final_pdf("Documents", doc_id),
+                               file_name=f"{doc_id}_{doc['client_name'].replace(' ','_')}.pdf")
+        elif status.startswith("failed"):
+            st.error(f"The PDF couldn't be rendered ({status[8:]}).")
+            if st.button("🔁 Try again"):
+                persist_pdf("Documents", doc_id)
+                st.rerun()
+        else:
+            if status == "missing":
+                persist_pdf("Documents", doc_id)
+            st.info("⏳ The signed PDF is being prepared…")
+            if st.button("🔄 Refresh"):
+                st.rerun()
         st.components.v1.html(html, height=800, scrolling=True)
         return
 
     st.info(f"**{doc['doc_type']}** for **{doc['client_name']}** — {doc['project_name']}")
-    st.components.v1.html(build_html(doc), height=800, scrolling=True)
+    st.components.v1.html(preview_html(doc), height=800, scrolling=True)
 
     st.markdown("---")
     st.subheader("Approve")
@@ -1189,9 +3249,14 @@ def approval_page(doc_id, token):
             approve_doc(doc_id, mgr_name, sig_b64)
             st.success("Approved! PDF is ready.")
             st.balloons()
-            doc["approved_by"] = mgr_name
-            html = build_html(doc, sig_b64 or None)
-            pdf = make_pdf(html)
+            doc  = get_document(doc_id) or doc
+            try:
+                with st.spinner("Preparing the signed PDF…"):
+                    pdf = final_pdf("Documents", doc_id)
+            except Exception as e:
+                st.error(f"The approval is saved, but the PDF couldn't be rendered right now ({e}). "
+                         "Open this link again to download it.")
+                return
             pdf_filename = f"{doc_id}_{doc['client_name'].replace(' ','_')}.pdf"
             st.download_button("📥 Download Approved PDF", pdf, file_name=pdf_filename)
 
@@ -1207,9 +3272,8 @@ def approval_page(doc_id, token):
                     f"Regards,\nMIRU GRC"
                 )
                 try:
-                    with st.spinner("Sending email…"):
-                        send_invoice_email(client_email.strip(), cc_list, subject, body, pdf, pdf_filename)
-                    st.success(f"📧 Email sent to {client_email.strip()}" + (f" (cc: {', '.join(cc_list)})" if cc_list else ""))
+                    queue_invoice_email(doc_id, client_email.strip(), cc_list, subject, body, pdf, pdf_filename)
+                    st.success(f"📧 Email queued for {client_email.strip()}" + (f" (cc: {', '.join(cc_list)})" if cc_list else ""))
                 except Exception as e:
                     st.error(f"Email failed: {e}")
         else:
@@ -1754,14 +3818,56 @@ def documents_tab():
     ftype   = c1.selectbox("Type",   ["All", "Quotation", "Proforma Invoice", "Tax Invoice", "Challan"])
     fstatus = c2.selectbox("Status", ["All", "Draft", "Pending Approval", "Approved"])
 
-    filtered = [
-        d for d in reversed(docs)
-        if (ftype   == "All" or d.get("doc_type") == ftype)
-        and (fstatus == "All" or d.get("status")   == fstatus)
-    ]
-
-    icons   = {"Draft": "🟡", "Pending Approval": "🟠", "Approved": "🟢"}
-    app_url = st.secrets["app"]["app_url"]
+    filtered = find_documents(ftype, fstatus)
+
+    with st.expander("📦 Bulk Export (ZIP)"):
+        e1, e2, e3, e4 = st.columns(4)
+        xtype    = e1.selectbox("Type", ["All", "Quotation", "Proforma Invoice", "Tax Invoice", "Challan"],
+                                index=3, key="bx_type")
+        xstatus  = e2.selectbox("Status", ["All", "Draft", "Pending Approval", "Approved"],
+                                index=3, key="bx_status")
+        clients  = sorted({str(d.get("client_name", "")) for d in docs if d.get("client_name")})
+        xclient  = e3.selectbox("Client", ["All"] + clients, key="bx_client")
+        last_eom = date.today().replace(day=1) - timedelta(days=1)   # default: last month
+        xdates   = e4.date_input("Date range", (last_eom.replace(day=1), last_eom), key="bx_dates")
+        start, end = (list(xdates) * 2)[:2] if xdates else (date.min, date.max)   # one date picked so far = that day
+        export = [d for d in find_documents(xtype, xstatus)
+                  if (xclient == "All" or d.get("client_name") == xclient)
+                  and start.isoformat() <= str(d.get("doc_date", ""))[:10] <= end.isoformat()]
+        st.caption(f"{len(export)} document(s) match.")
+        if st.button("📦 Build ZIP", disabled=not export, key="bx_build"):
+            bar = st.progress(0.0, text="Rendering…")
+            zip_bytes, failed = export_documents_zip(
+                export, on_progress=lambda n, total: bar.progress(n / total, text=f"Rendered {n} of {total}"))
+            if failed:
+                st.warning(f"{len(failed)} document(s) failed and were left out: " +
+                           ", ".join(f"{k} ({v})" for k, v in failed.items()))
+            st.download_button("⬇️ Download ZIP", zip_bytes, key="bx_dl",
+                               file_name=f"documents_{start:%Y%m%d}-{end:%Y%m%d}.zip", mime="application/zip")
+
+    with st.expander("✉️ Email Statements"):
+        last_eom   = date.today().replace(day=1) - timedelta(days=1)
+        sdates     = st.date_input("Period", (last_eom.replace(day=1), last_eom), key="st_dates")
+        start, end = (list(sdates) * 2)[:2] if sdates else (last_eom.replace(day=1), last_eom)
+        batches    = statement_batches(start, end)
+        st.dataframe([{"Client": c["name"], "Email": c.get("email", "") or "⚠️ none",
+                       "Documents": ", ".join(d["doc_id"] for d in ds)} for c, ds in batches],
+                      hide_index=True, use_container_width=True)
+        dry_run = st.checkbox("Dry run (send to the local test SMTP server)", value=True, key="st_dry")
+        if st.button("✉️ Send Statements", disabled=not batches, key="st_send"):
+            bar = st.progress(0.0, text="Preparing…")
+            results = send_statements(
+                batches, start, end, dry_run=dry_run,
+                on_progress=lambda n, total, name: bar.progress(n / total, text=f"{name} ({n} of {total})"))
+            sent = [k for k, v in results.items() if v == "sent"]
+            st.success(f"Sent {len(sent)} of {len(results)} statement(s)" + (" to the test server." if dry_run else "."))
+            for k, v in results.items():
+                if v != "sent":
+                    st.warning(f"{k}: {v}")
+
+    icons    = {"Draft": "🟡", "Pending Approval": "🟠", "Approved": "🟢"}
+    app_url  = st.secrets["app"]["app_url"]
+    has_smtp = bool(st.secrets.get("smtp"))
 
     for doc in filtered:
         icon  = icons.get(doc.get("status", ""), "⚪")
@@ -1773,6 +3879,20 @@ def documents_tab():
             cc.write(f"**Project:** {doc.get('project_name','')}")
             if doc.get("notes"):
                 st.caption(f"Notes: {doc['notes']}")
+            mail = email_status(doc["doc_id"]) if doc["status"] == "Approved" and has_smtp else None
+            if mail:
+                to = ", ".join(mail["recipients"])
+                if mail["status"] == "sent":
+                    st.caption(f"📧 Emailed to {to} on {mail['sent_at'][:16].replace('T', ' ')}")
+                elif mail["status"] == "queued":
+                    st.caption(f"📧 Email to {to} queued" +
+                               (f" — retrying after: {mail['last_error']}" if mail["attempts"] else ""))
+                else:
+                    m1, m2 = st.columns([4, 1])
+                    m1.warning(f"📧 Email to {to} failed: {mail['last_error']}")
+                    if m2.button("Resend", key=f"resend_{doc['doc_id']}"):
+                        _outbox().retry(mail["id"])
+                        st.rerun()
 
             act1, act2, act3 = st.columns(3)
 
@@ -1825,7 +3945,7 @@ def documents_tab():
                             verified_mgr = st.session_state[pin_key]
                             st.success(f"Viewing as {verified_mgr}")
                             d = get_document(doc["doc_id"])
-                            st.components.v1.html(build_html(d, watermark=True), height=700, scrolling=True)
+                            st.components.v1.html(preview_html(d, watermark=True), height=700, scrolling=True)
                             if st.button("✅ Approve Document", key=f"approve_{doc['doc_id']}", type="primary"):
                                 mgr2 = next((m for m in managers if m["name"] == verified_mgr), None)
                                 sig_b64 = str(mgr2.get("signature_b64", "")) if mgr2 else ""
@@ -1842,9 +3962,7 @@ def documents_tab():
 
                 # ── Generate document PDF ──
                 if pdf_col.button("📥 Generate PDF", key=f"pdf_{doc['doc_id']}", use_container_width=True):
-                    d    = get_document(doc["doc_id"])
-                    html = build_html(d, d.get("signature_b64") or None)
-                    pdf  = make_pdf(html)
+                    pdf  = final_pdf("Documents", doc["doc_id"])
                     pdf_col.download_button(
                         "⬇️ Save PDF", pdf,
                         file_name=f"{doc['doc_id']}_{doc.get('client_name','').replace(' ','_')}.pdf",
@@ -1936,7 +4054,7 @@ def documents_tab():
                             "notes":            cd_purp,
                             "items":            [it for it in cd_items if float(it["qty"]) > 0],
                         }
-                        st.components.v1.html(build_html_challan(preview_data), height=700, scrolling=True)
+                        st.components.v1.html(preview_html(preview_data), height=700, scrolling=True)
 
                     st.markdown("---")
                     btn_save, btn_cancel = st.columns(2)
@@ -1981,11 +4099,33 @@ def dispatches_tab():
         return
 
     fs = st.selectbox("Filter by Status", ["All", "Draft", "Finalized"], key="disp_filter")
-    filtered = [d for d in reversed(dispatches) if fs == "All" or d.get("status") == fs]
+    filtered = find_dispatches(fs)
     if not filtered:
         st.info(f"No {fs} dispatches.")
         return
 
+    finalized = [d for d in dispatches if d.get("status") == "Finalized"]
+    with st.expander("🖨️ Print Challans"):
+        today = date.today().isoformat()
+        names = {d["dispatch_id"]: d.get("client_name", "") for d in finalized}
+        pick  = st.multiselect("Dispatches", list(names),
+                               default=[d["dispatch_id"] for d in finalized
+                                        if str(d.get("finalized_at", ""))[:10] == today],
+                               format_func=lambda k: f"{k} — {names[k]}", key="pc_pick")
+        as_one = st.radio("Output", ["One combined PDF", "ZIP of PDFs"], horizontal=True, key="pc_mode") == "One combined PDF"
+        if st.button("🖨️ Prepare", disabled=not pick, key="pc_build"):
+            bar = st.progress(0.0, text="Rendering…")
+            out, failed = print_challans(
+                pick, combined=as_one,
+                on_progress=lambda n, total: bar.progress(n / total, text=f"Ready {n} of {total}"))
+            if failed:
+                st.warning(f"{len(failed)} challan(s) failed and were left out: " +
+                           ", ".join(f"{k} ({v})" for k, v in failed.items()))
+            if len(failed) < len(pick):
+                st.download_button("⬇️ Download", out, key="pc_dl",
+                                   file_name=f"challans_{today}." + ("pdf" if as_one else "zip"),
+                                   mime="application/pdf" if as_one else "application/zip")
+
     icons = {"Draft": "🟡", "Finalized": "🟢"}
 
     for disp in filtered:
@@ -2010,21 +4150,7 @@ def dispatches_tab():
                 fa1, fa2 = st.columns(2)
                 if fa1.button("📄 Re-download Challan PDF",
                               key=f"redl_{disp['dispatch_id']}", use_container_width=True):
-                    challan_data = {
-                        "doc_id":           disp["dispatch_id"],
-                        "doc_type":         "Challan",
-                        "client_name":      disp.get("client_name",""),
-                        "project_name":     disp.get("project_name",""),
-                        "billing_address":  disp.get("billing_address",""),
-                        "delivery_address": disp.get("delivery_address",""),
-                        "doc_date":         str(disp.get("finalized_at","") or disp.get("created_at",""))[:10],
-                        "vehicle_no":       disp.get("vehicle_no",""),
-                        "transporter_name": disp.get("transporter_name",""),
-                        "transport_mode":   disp.get("transport_mode","Road"),
-                        "notes":            disp.get("purpose","Supply"),
-                        "items":            disp.get("items",[]),
-                    }
-                    pdf = make_pdf(build_html_challan(challan_data))
+                    pdf = final_pdf("Dispatches", disp["dispatch_id"])
                     st.download_button(
                         "⬇️ Save Challan PDF", pdf,
                         file_name=f"{disp['dispatch_id']}_{disp.get('client_name','').replace(' ','_')}.pdf",
@@ -2036,6 +4162,7 @@ def dispatches_tab():
                     updated = dict(disp)
                     updated["status"]       = "Draft"
                     updated["finalized_at"] = ""
+                    updated["pdf_sha256"]   = ""
                     save_dispatch(updated, edit_id=disp["dispatch_id"])
                     st.success("Reopened as Draft — you can now edit it below.")
                     st.rerun()
@@ -2185,23 +4312,10 @@ def dispatches_tab():
                     updated["items"]            = finalized_items
                     updated["status"]           = "Finalized"
                     updated["finalized_at"]     = datetime.now().isoformat()
+                    updated["pdf_sha256"]       = ""
                     save_dispatch(updated, edit_id=disp["dispatch_id"])
-
-                    challan_data = {
-                        "doc_id":           disp["dispatch_id"],
-                        "doc_type":         "Challan",
-                        "client_name":      disp.get("client_name",""),
-                        "project_name":     disp.get("project_name",""),
-                        "billing_address":  disp.get("billing_address",""),
-                        "delivery_address": disp.get("delivery_address",""),
-                        "doc_date":         str(date.today()),
-                        "vehicle_no":       e_vno,
-                        "transporter_name": e_tsp,
-                        "transport_mode":   e_mode,
-                        "notes":            e_purp,
-                        "items":            finalized_items,
-                    }
-                    pdf = make_pdf(build_html_challan(challan_data))
+                    persist_pdf("Dispatches", disp["dispatch_id"])
+                    pdf = final_pdf("Dispatches", disp["dispatch_id"])
                     st.download_button(
                         "⬇️ Download Challan PDF", pdf,
                         file_name=f"{disp['dispatch_id']}_{disp.get('client_name','').replace(' ','_')}.pdf",
@@ -2239,8 +4353,16 @@ def work_orders_tab():
         if boq_file and st.button("✨ Extract & Pre-fill", type="primary", key="boq_extract"):
             with st.spinner("Reading document with AI..."):
                 try:
-                    extracted = extract_boq_from_file(boq_file)
+                    live = st.empty()
+                    def show(done, total, partial):
+                        with live.container():
+                            st.caption(f"Read {done} of {total} page ranges — {len(partial['items'])} items so far")
+                            st.dataframe(partial["items"], use_container_width=True)
+                    extracted = extract_boq_from_file(boq_file, on_progress=show)
+                    live.empty()
                     st.session_state["boq_extracted"] = extracted
+                    for w in extracted.get("warnings", []):
+                        st.warning(f"Not read — {w}. Extract again to retry just these pages.")
                     st.success(f"✅ Extracted {len(extracted.get('items', []))} items — scroll down to the form, fields are pre-filled.")
                     st.json(extracted)
                 except Exception as e:
@@ -2274,7 +4396,7 @@ def work_orders_tab():
         st.caption("Enter items directly here — they will be automatically added to the Items catalog when you save.")
         ex_items = ai["items"] if ai else (ew["items"] if ew else [])
 
-        wo_item_count = st.number_input("Number of items", 1, 30, value=max(1, len(ex_items)), step=1, key=f"wo_ic_{wok}")
+        wo_item_count = st.number_input("Number of items", 1, 200, value=max(1, len(ex_items)), step=1, key=f"wo_ic_{wok}")
         wo_items = []
 
         # Column headers
@@ -2395,7 +4517,7 @@ def work_orders_tab():
             # Auto-sync items to the Items catalog (upsert by description)
             existing_catalog = get_items()
             existing_descs   = {it["description"]: (i, it) for i, it in enumerate(existing_catalog)}
-            synced = 0
+            synced = []
             for it in wo_items:
                 if not it["description"].strip():
                     continue
@@ -2411,14 +4533,12 @@ def work_orders_tab():
                     "category":         wo_project,
                     "sale_types":       json.dumps(["Supply", "Installation", "Supply & Installation"]),
                 }
-                if it["description"] in existing_descs:
-                    idx, _ = existing_descs[it["description"]]
-                    save_item(item_data, edit_idx=idx)
-                else:
-                    save_item(item_data)
-                synced += 1
+                idx = existing_descs[it["description"]][0] if it["description"] in existing_descs else None
+                synced.append((item_data, idx))
+            if synced:
+                save_items(synced)
 
-            st.success(f"Work Order **{wo_id}** saved. {synced} item(s) synced to catalog.")
+            st.success(f"Work Order **{wo_id}** saved. {len(synced)} item(s) synced to catalog.")
             st.rerun()
 
     # List all WOs
@@ -2554,11 +4674,9 @@ def settings_tab():
             buf = BytesIO()
             img.save(buf, format="PNG", optimize=True)
             sig_b64 = base64.b64encode(buf.getvalue()).decode()
-            ws = get_sheet().worksheet("Managers")
             for i, r in enumerate(_fetch_managers()):
                 if r["name"] == chosen:
-                    ws.update(f"D{i+2}", [[sig_b64]])
-                    _bust()
+                    _sheet_update("Managers", f"D{i+2}", [[sig_b64]])
                     st.success(f"Signature saved for {chosen}.")
                     break
 
@@ -2582,6 +4700,29 @@ def settings_tab():
         })
         st.success("Bank details saved — will appear on all future PDFs.")
 
+    rep = _replica()
+    if rep:
+        st.markdown("---")
+        st.subheader("🗄️ Local Replica")
+        wm = rep.watermark()
+        st.caption(f"Last full sync from Google Sheets: {wm[:19].replace('T', ' ') if wm else 'never'}")
+        if st.button("♻️ Rebuild Replica"):
+            rep.rebuild()
+            _read_sheets(list(REPLICA_SCHEMA), fresh=True)
+            _fetch_snapshot.clear()
+            _fetch_settings.clear()
+            st.success("Replica rebuilt from Google Sheets.")
+
+    st.markdown("---")
+    with st.expander("📊 Sheets API usage (this server process)"):
+        stats = _storage().stats
+        st.table(storage_stats())
+        st.caption(f"Retries: {sum(n for (k, _), n in stats.items() if k == 'retry')} | "
+                   f"Throttled: {stats[('wait_s', 'read')] + stats[('wait_s', 'write')]:.1f} s")
+
+    with st.expander("🖨️ PDF rendering (this server process)"):
+        st.table(_render_client().report())
+
 # ── Main ───────────────────────────────────────────────────────────────────────
 
 def main():
@@ -2607,6 +4748,7 @@ def main():
 
     nav = st.radio("", ["📄 New Document", "📂 All Documents", "📦 Dispatches", "📋 Work Orders", "🗂️ Clients & Items", "⚙️ Settings"],
                    horizontal=True, label_visibility="collapsed", key="nav")
+    st.caption(f"🕒 Data as of {data_as_of():%d %b %Y, %H:%M:%S}")
 
     if nav == "📄 New Document":
         edit_id = qp.get("edit")
@@ -2648,7 +4790,7 @@ def main():
         with b2:
             if st.button("👁️ Preview", use_container_width=True):
                 form_data["doc_id"] = edit_id or "PREVIEW"
-                html = build_html(form_data, watermark=True)
+                html = preview_html(form_data, watermark=True)
                 st.components.v1.html(html, height=900, scrolling=True)
             if st.button("🔄 Clear Form", use_container_width=True):
                 for k in list(st.session_state.keys()):